@@ -1,15 +1,21 @@
 import csv
 import os
 import re
+import shutil
+import struct
 import sys
+import tempfile
+from itertools import islice
 from argparse import ArgumentParser
-from collections import defaultdict
-from os.path import abspath, dirname, join
+from collections import defaultdict, OrderedDict
+from multiprocessing import Pool
+from os.path import abspath, dirname, join, splitext
 
 import fiona
-from geoalchemy2.shape import to_shape
+import numpy
 from rtree import index
-from shapely.geometry import mapping, shape
+from shapely import vectorized, wkb
+from shapely.geometry import shape, Point
 from shapely.geometry.base import BaseGeometry
 from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker
@@ -26,45 +32,76 @@ TAXLOTS = join(RLIS_DIR, 'TAXLOTS', 'taxlots.shp')
 ADDR_PTS = join(RLIS_DIR, 'TAXLOTS', 'master_address.shp')
 CENSUS_PTS = join(HOME, 'shp', 'census_address_points.shp')
 POINTS_COUNT = join(HOME, 'csv', 'address_count_by_census_unit.csv')
+JOIN_REPORT = join(HOME, 'csv', 'census_join_report.csv')
 
 TLID_FIX_STR = '\s+-*0*'
+TLID_FIX_RE = re.compile(TLID_FIX_STR)
+
+# coded against prop code definitions on pg 136 in this manual:
+# http://www.oregon.gov/DOR/forms/FormsPubs/ratio_manual_150-303-437.pdf
+# prop codes that match this string are address that have people
+# living at them (as best as I could discern)
+PROP_CODE_STR = '0[014-79][139]|' \
+                '[14-7][0-9]?[1-9]?|' \
+                '9[08][1-69]'
+PROP_CODE_RE = re.compile(PROP_CODE_STR)
 PG_URL = 'postgresql://{user}:{password}@{host}/{db}'
 
-
-def create_census_address_points():
-    """"""
-
-    # coded against prop code definitions on pg 136 in this manual:
-    # http://www.oregon.gov/DOR/forms/FormsPubs/ratio_manual_150-303-437.pdf
-    # prop codes that match this string are address that have people
-    # living at them (as best as I could discern)
-    prop_code_str = '0[014-79][139]|' \
-                    '[14-7][0-9]?[1-9]?|' \
-                    '9[08][1-69]'
+# default extent (min x, min y, max x, max y in ospn feet) that census
+# geometries are fetched within, roughly the tri-county area
+CENSUS_ENVELOPE = (7469314, 452285, 7891194, 781860)
+CENSUS_SRID = 2913
+FETCH_SIZE = 5000
+
+# in parallel mode the address point extent is split into a grid with
+# this many tiles per side, there are more tiles than processes so that
+# tiles with few points don't leave workers idle
+TILE_GRID = 8
+
+# number of features handed to each writerecords call
+WRITE_BATCH = 10000
+
+# number of .dbf records whose requested columns are copied out of the
+# memory mapped file at a time
+DBF_CHUNK = 100000
+
+# census units that address points are assigned to
+CENSUS_LEVELS = ['bg', 'tract']
+
+# the number of leading geoid characters that identify each census unit,
+# each unit nests completely within those above it so coarser geoids can
+# be derived from finer ones, only the units with a model in the census
+# database can be spatially joined
+GEOID_LENGTHS = OrderedDict([('county', 5), ('tract', 11), ('bg', 12)])
+CENSUS_MODELS = {'bg': Bg, 'tract': Tract}
+
+# non-census polygon layers that address points are also assigned to, each
+# is a (name, shapefile path, id field) triple and the name becomes the
+# field holding the layer's id on the output points, for example:
+# ('nbo_hood', join(RLIS_DIR, 'BOUNDARY', 'nbo_hood.shp'), 'NAME')
+ZONE_LAYERS = []
+
+
+def create_census_address_points(levels=CENSUS_LEVELS, hierarchical=True,
+                                 processes=1, zones=ZONE_LAYERS):
+    """Write the address points that are residences to shapefile with the
+    geoid of each of the supplied census levels and the id of each of the
+    supplied zone layers attached.  The number of points in each distinct
+    combination of units is tallied as the points are written, those
+    counts are returned along with the names of the layers in the order
+    the unit combinations are given in.  In hierarchical mode only the
+    finest census level is spatially joined and the others are derived
+    from its geoids, otherwise every level is joined, every zone layer is
+    always joined.  If more than one process is requested the address
+    points are split into tiles that are handled in a process pool.
+
+    In serial mode the address points are read in a single pass, homes
+    are classified as they're read and are joined and written a batch at
+    a time so that only one batch of features is held in memory"""
+
+    levels = sorted(levels, key=GEOID_LENGTHS.get, reverse=True)
     prop_code_map = get_prop_code_by_tlid()
 
-    homes = dict()
-    with fiona.open(ADDR_PTS) as addr_pts:
-        homes_meta = addr_pts.meta.copy()
-
-        for fid, feat in addr_pts.items():
-            fields = feat['properties']
-            tlid = fields['TLID']
-
-            if tlid:
-                clean_tlid = re.sub(TLID_FIX_STR, '', tlid)
-                try:
-                    prop_code = prop_code_map[clean_tlid]
-                except KeyError:
-                    # if the landuse is unknown the address is dropped
-                    # since a ratio of the points and the lack of a prop
-                    # code seems random things should even out
-                    continue
-
-                if re.match(prop_code_str, prop_code):
-                    fields['prop_code'] = prop_code
-                    homes[fid] = feat
-
     # get census tracts and block groups from the postgres database on
     # the map server
     pg_url = PG_URL.format(
@@ -73,65 +110,506 @@ def create_census_address_points():
         host=pg.host,
         db=pg.dbname)
     engine = create_engine(pg_url)
-    bg = get_spatial_table_from_db(engine, Bg, ['geoid'])
-    bg_ix = generate_spatial_index(bg)
-    bg_mapping = spatial_join(homes, bg, bg_ix)
+    census_units = get_census_units(engine, levels, hierarchical, pg.envelope)
+
+    # zone layers are joined right along with the census units, all of
+    # them are loaded and indexed once up front
+    layers = list(levels)
+    for name, zone_path, id_field in zones:
+        census_units[name] = get_zone_units(zone_path, id_field)
+        layers.append(name)
 
-    tract = get_spatial_table_from_db(engine, Tract, ['geoid'])
-    tract_ix = generate_spatial_index(tract)
-    tract_mapping = spatial_join(homes, tract, tract_ix)
+    with fiona.open(ADDR_PTS) as addr_pts:
+        homes_meta = addr_pts.meta.copy()
+        addr_bounds = addr_pts.bounds
 
     home_fields = homes_meta['schema']['properties']
-    home_fields['bg'] = 'str'
-    home_fields['tract'] = 'str'
+    for layer in layers:
+        home_fields[layer] = 'str'
     home_fields['prop_code'] = 'str'
 
+    if processes > 1:
+        census_count = join_address_tiles(
+            census_units, prop_code_map, levels, layers, homes_meta,
+            addr_bounds, processes, engine)
+        return census_count, layers
+
+    units_ixs = {layer: generate_spatial_index(units)
+                 for layer, units in census_units.items()}
+
+    census_count = defaultdict(int)
+    finest_geoids = set()
+    report_rows = list()
+    with fiona.open(ADDR_PTS) as addr_pts:
+        homes = get_homes(addr_pts.items(), prop_code_map)
+        with fiona.open(CENSUS_PTS, 'w', **homes_meta) as census_pts:
+            for batch in iter_batches(homes, WRITE_BATCH):
+                # points with null geometry can't be joined or written
+                batch = [(fid, feat) for fid, feat in batch
+                         if feat['geometry']]
+                if not batch:
+                    continue
+
+                t_fids = numpy.array([fid for fid, feat in batch])
+                coords = numpy.array(
+                    [feat['geometry']['coordinates'][:2]
+                     for fid, feat in batch], dtype=float)
+                census_geoids, batch_report = join_census_units(
+                    t_fids, coords[:, 0], coords[:, 1],
+                    census_units, levels, units_ixs)
+
+                batch_count = write_census_points(
+                    census_pts, batch, census_geoids, layers)
+                for units, count in batch_count.items():
+                    census_count[units] += count
+
+                finest_geoids.update(census_geoids[levels[0]].values())
+                report_rows.extend(batch_report)
+
+    write_join_report(report_rows)
+    check_derived_geoids(engine, finest_geoids, census_units, levels)
+
+    return census_count, layers
+
+
+def get_homes(features, prop_code_map):
+    """Yield the supplied (fid, feature) pairs whose taxlot has a prop
+    code indicating that people live there, with the prop code added to
+    the feature's properties"""
+
+    for fid, feat in features:
+        fields = feat['properties']
+        tlid = fields['TLID']
+
+        if tlid:
+            clean_tlid = TLID_FIX_RE.sub('', tlid)
+            try:
+                prop_code = prop_code_map[clean_tlid]
+            except KeyError:
+                continue
+
+            if PROP_CODE_RE.match(prop_code):
+                fields['prop_code'] = prop_code
+                yield fid, feat
+
+
+def iter_batches(items, size):
+    """Yield lists of up to 'size' consecutive items from the iterable"""
+
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+
+def write_census_points(census_pts, homes, census_geoids, layers):
+    """Attach the geoid or id of each of the supplied layers to each of
+    the (fid, feature) pairs from the 'homes' iterable and write them to
+    the open collection in batches.  The number of homes in each distinct
+    combination of units (a tuple ordered like 'layers') is counted along
+    the way and returned"""
+
+    census_count = defaultdict(int)
+    batch = list()
+    for fid, feat in homes:
+        fields = feat['properties']
+        for layer in layers:
+            fields[layer] = census_geoids[layer].get(fid)
+
+        census_count[tuple(fields[layer] for layer in layers)] += 1
+
+        batch.append(feat)
+        if len(batch) >= WRITE_BATCH:
+            census_pts.writerecords(batch)
+            batch = list()
+
+    census_pts.writerecords(batch)
+    return census_count
+
+
+def get_zone_units(zone_path, id_field):
+    """Read the polygons of a zone layer into features with shapely
+    geometries, the id of each zone is stored as its 'geoid' so that zones
+    can be joined exactly like census units"""
+
+    zone_units = dict()
+    with fiona.open(zone_path) as zones:
+        for fid, feat in zones.items():
+            # null ids stay None so they aren't counted as a zone
+            zone_id = feat['properties'][id_field]
+            if zone_id is not None:
+                zone_id = unicode(zone_id)
+
+            zone_units[fid] = dict(
+                geometry=shape(feat['geometry']),
+                properties={'geoid': zone_id})
+
+    return zone_units
+
+
+def get_census_units(engine, levels, hierarchical=True,
+                     envelope=CENSUS_ENVELOPE):
+    """Fetch the features of the census levels that need to be spatially
+    joined, in hierarchical mode that is only the finest of the supplied
+    levels (which must be sorted finest first)"""
+
+    if hierarchical:
+        join_levels = levels[:1]
+    else:
+        join_levels = levels
+
+    census_units = OrderedDict()
+    for level in join_levels:
+        census_units[level] = get_spatial_table_from_db(
+            engine, CENSUS_MODELS[level], ['geoid'], envelope=envelope)
+
+    return census_units
+
+
+def join_census_units(t_fids, xs, ys, census_units, levels, units_ixs=None):
+    """Return a dictionary keyed on census level whose values map the fid
+    of each home to the geoid of the unit of that level it falls within,
+    along with a list of report rows for the homes that fall in no census
+    unit or in more than one unit or zone.  Only the levels in
+    'census_units' (which may also hold zone layers) are spatially joined,
+    geoids for the other (coarser) census levels are the leading
+    characters of those of the finest level.  Spatial indexes of the units
+    can be supplied in 'units_ixs' when points are joined in batches,
+    otherwise they are built here"""
+
+    census_geoids = dict()
+    report_rows = list()
+    for level, units in census_units.items():
+        if units_ixs:
+            units_ix = units_ixs[level]
+        else:
+            units_ix = generate_spatial_index(units)
+        # being outside of every zone is normal so only census units that
+        # a point misses are reported
+        join_ix, problems = spatial_join(
+            t_fids, xs, ys, units, units_ix,
+            report_unmatched=level in GEOID_LENGTHS)
+
+        matched = join_ix != -1
+        census_geoids[level] = {
+            fid: units[u_fid]['properties']['geoid']
+            for fid, u_fid in zip(t_fids[matched].tolist(),
+                                  join_ix[matched].tolist())}
+
+        for fid, u_fids in sorted(problems.items()):
+            geoids = [units[u]['properties']['geoid'] for u in u_fids]
+            issue = 'multiple matches' if geoids else 'no match'
+            report_rows.append((level, fid, issue, ' '.join(geoids)))
+
+    finest_geoids = census_geoids[levels[0]]
+    for level in levels[1:]:
+        if level not in census_geoids:
+            geoid_len = GEOID_LENGTHS[level]
+            census_geoids[level] = {
+                fid: geoid[:geoid_len]
+                for fid, geoid in finest_geoids.items()}
+
+    return census_geoids, report_rows
+
+
+def check_derived_geoids(engine, finest_geoids, census_units, levels):
+    """Run the nesting check, against the set of geoids of the finest
+    census level, for each level whose geoids were derived rather than
+    joined"""
+
+    finest = levels[0]
+    for level in levels[1:]:
+        if level not in census_units:
+            check_census_nesting(engine, finest, level, finest_geoids)
+
+
+def write_join_report(report_rows):
+    """"""
+
+    if report_rows:
+        print '{} address point joins could not be resolved, see: ' \
+              '{}'.format(len(report_rows), JOIN_REPORT)
+
+        with open(JOIN_REPORT, 'wb') as report_csv:
+            report_writer = csv.writer(report_csv)
+            report_writer.writerow(('level', 'fid', 'issue', 'geoids'))
+            report_writer.writerows(report_rows)
+
+
+def join_address_tiles(census_units, prop_code_map, levels, layers,
+                       homes_meta, addr_bounds, processes, engine,
+                       tile_grid=TILE_GRID):
+    """Split the address point extent into a grid of tiles and join the
+    homes of each tile in a process pool.  The address points are read and
+    classified once here and the fids, coordinates and prop codes of the
+    homes are bucketed by tile, every tile is sent those along with only
+    the census units that intersect it and writes its homes to a partial
+    shapefile, once all tiles are done the parts are merged into the
+    census points shapefile and the combined census unit counts of the
+    tiles are returned"""
+
+    fids = list()
+    coords = list()
+    prop_codes = list()
+    with fiona.open(ADDR_PTS) as addr_pts:
+        for fid, feat in get_homes(addr_pts.items(), prop_code_map):
+            # points with null geometry can't be joined or written
+            if feat['geometry']:
+                fids.append(fid)
+                coords.append(feat['geometry']['coordinates'][:2])
+                prop_codes.append(feat['properties']['prop_code'])
+
+    fids = numpy.array(fids, dtype=int)
+    coords = numpy.array(coords, dtype=float).reshape(-1, 2)
+    prop_codes = numpy.array(prop_codes, dtype=object)
+
+    min_x, min_y, max_x, max_y = addr_bounds
+    x_edges = numpy.linspace(min_x, max_x, tile_grid + 1)
+    y_edges = numpy.linspace(min_y, max_y, tile_grid + 1)
+
+    # points on an interior tile edge belong to the tile above or to the
+    # right of it, the outermost edges are inclusive
+    cols = numpy.searchsorted(x_edges, coords[:, 0], side='right') - 1
+    rows = numpy.searchsorted(y_edges, coords[:, 1], side='right') - 1
+    tile_ids = numpy.clip(cols, 0, tile_grid - 1) * tile_grid + \
+        numpy.clip(rows, 0, tile_grid - 1)
+
+    # a stable sort keeps the homes of each tile in fid order
+    tile_order = numpy.argsort(tile_ids, kind='mergesort')
+    tile_starts = numpy.searchsorted(
+        tile_ids[tile_order], numpy.arange(tile_grid ** 2 + 1))
+
+    units_ixs = {level: generate_spatial_index(units)
+                 for level, units in census_units.items()}
+    parts_dir = tempfile.mkdtemp(dir=dirname(CENSUS_PTS))
+
+    tiles = list()
+    for i in range(tile_grid):
+        for j in range(tile_grid):
+            tile_id = i * tile_grid + j
+            tile_homes = tile_order[
+                tile_starts[tile_id]:tile_starts[tile_id + 1]]
+            if not tile_homes.size:
+                continue
+
+            tile = (x_edges[i], y_edges[j], x_edges[i + 1], y_edges[j + 1])
+            tile_units = OrderedDict()
+            for level, units in census_units.items():
+                tile_units[level] = {
+                    u_fid: units[u_fid]
+                    for u_fid in units_ixs[level].intersection(tile)}
+
+            part_path = join(parts_dir, 'part_{}.shp'.format(len(tiles)))
+            tiles.append((fids[tile_homes], coords[tile_homes],
+                          prop_codes[tile_homes], tile_units,
+                          levels, layers, homes_meta, part_path))
+
+    pool = Pool(processes)
+    results = pool.map(join_address_tile, tiles, chunksize=1)
+    pool.close()
+    pool.join()
+
+    census_geoids = defaultdict(dict)
+    census_count = defaultdict(int)
+    report_rows = list()
+    for part_path, tile_geoids, tile_count, tile_report in results:
+        census_geoids[levels[0]].update(tile_geoids)
+        report_rows.extend(tile_report)
+        for geoid, count in tile_count.items():
+            census_count[geoid] += count
+
+    write_join_report(report_rows)
+    check_derived_geoids(engine, set(census_geoids[levels[0]].values()),
+                         census_units, levels)
+
     with fiona.open(CENSUS_PTS, 'w', **homes_meta) as census_pts:
-        for fid, feat in homes.items():
-            fields = feat['properties']
-            fields['bg'] = bg[bg_mapping[fid]]['properties']['geoid']
-            fields['tract'] = tract[tract_mapping[fid]]['properties']['geoid']
+        for part_path, tile_geoids, tile_count, tile_report in results:
+            with fiona.open(part_path) as part:
+                census_pts.writerecords(part)
+
+    shutil.rmtree(parts_dir)
+    return census_count
+
+
+def join_address_tile(tile_args):
+    """Join the homes of a single tile, supplied as arrays of their fids,
+    coordinates and prop codes, to the census units and write them to the
+    tile's partial shapefile, the features themselves are fetched from the
+    address points by fid as they are written.  The path of that
+    shapefile, the geoids of the finest census level, the census unit
+    counts and the join report rows are returned"""
+
+    (t_fids, coords, prop_codes, tile_units,
+     levels, layers, homes_meta, part_path) = tile_args
+
+    census_geoids, report_rows = join_census_units(
+        t_fids, coords[:, 0], coords[:, 1], tile_units, levels)
+
+    with fiona.open(ADDR_PTS) as addr_pts:
+        homes = get_homes_by_fid(addr_pts, t_fids, prop_codes)
+        with fiona.open(part_path, 'w', **homes_meta) as part:
+            census_count = write_census_points(
+                part, homes, census_geoids, layers)
+
+    return part_path, census_geoids[levels[0]], census_count, report_rows
+
 
-            census_pts.write(feat)
+def get_homes_by_fid(addr_pts, fids, prop_codes):
+    """Yield (fid, feature) pairs for the supplied fids of the open address
+    point collection with the matching prop code added to each feature's
+    properties"""
+
+    for fid, prop_code in zip(fids.tolist(), prop_codes.tolist()):
+        feat = addr_pts[fid]
+        feat['properties']['prop_code'] = prop_code
+        yield fid, feat
+
+
+def check_census_nesting(engine, fine_level, coarse_level, fine_geoids):
+    """Confirm that the geoids of the finer census level have the expected
+    length and that every coarse geoid derived from them as a prefix is a
+    real unit of the coarser level, if either check fails the derived
+    geoids can't be trusted so processing is halted"""
+
+    bad_geoids = [g for g in fine_geoids
+                  if len(g) != GEOID_LENGTHS[fine_level]]
+    if bad_geoids:
+        print 'The following {} geoids are not the expected length of {}, ' \
+              'coarser census units can not be derived from them: ' \
+              '{}'.format(fine_level, GEOID_LENGTHS[fine_level], bad_geoids)
+        exit()
+
+    if coarse_level not in CENSUS_MODELS:
+        return
+
+    session_maker = sessionmaker(bind=engine)
+    session = session_maker()
+    coarse_table = CENSUS_MODELS[coarse_level]
+    coarse_geoids = {g for g, in session.query(coarse_table.geoid)}
+    session.close()
+
+    geoid_len = GEOID_LENGTHS[coarse_level]
+    orphans = {g for g in fine_geoids if g[:geoid_len] not in coarse_geoids}
+    if orphans:
+        print 'The following {} geoids do not nest within any {} which ' \
+              'should not be possible, examine the census data for ' \
+              'issues: {}'.format(fine_level, coarse_level, sorted(orphans))
+        exit()
 
 
 def get_prop_code_by_tlid():
-    """"""
+    """Map cleaned taxlot ids to their prop code.  Only the two needed
+    columns are pulled from the taxlot .dbf so that none of the polygon
+    geometry or other attributes have to be parsed"""
+
+    taxlots_dbf = '{}.dbf'.format(splitext(TAXLOTS)[0])
+    columns = read_dbf_columns(taxlots_dbf, ['TLID', 'PROP_CODE'])
+
+    has_code = columns['PROP_CODE'] != ''
+    tlids = columns['TLID'][has_code]
+    prop_codes = columns['PROP_CODE'][has_code]
 
-    prop_code_map = dict()
-    with fiona.open(TAXLOTS) as taxlots:
-        for feat in taxlots:
-            fields = feat['properties']
-            clean_tlid = re.sub(TLID_FIX_STR, '', fields['TLID'])
-            prop_code = fields['PROP_CODE']
-            if prop_code:
-                prop_code_map[clean_tlid] = prop_code
+    # many taxlots share an id (stacked condo units for instance) so the
+    # ids are cleaned once per unique value and then broadcast back out
+    unique_tlids, inverse = numpy.unique(tlids, return_inverse=True)
+    clean_unique = numpy.array(
+        [TLID_FIX_RE.sub('', t) for t in unique_tlids.tolist()])
+    clean_tlids = clean_unique[inverse]
 
+    prop_code_map = dict(zip(clean_tlids.tolist(), prop_codes.tolist()))
     return prop_code_map
 
 
-def get_spatial_table_from_db(engine, table, fields, geom_col='geom'):
-    """"""
+def read_dbf_columns(dbf_path, columns, drop_deleted=True):
+    """Read the supplied columns from a dbase file into numpy arrays of
+    whitespace stripped strings, records flagged as deleted are dropped
+    unless 'drop_deleted' is False in which case their values are blanked
+    so that the arrays stay aligned with the record numbers.
+    The fixed width records are memory mapped and the requested fields
+    are copied out of them a chunk at a time, so only those columns are
+    ever held in memory and no other values are decoded, see here for the
+    file format: http://www.dbase.com/Knowledgebase/INT/db7_file_fmt.htm
+    """
+
+    with open(dbf_path, 'rb') as dbf:
+        rec_count, header_len, rec_len = struct.unpack(
+            '<xxxxLHH20x', dbf.read(32))
+
+        # field descriptors are 32 bytes each and follow the main header,
+        # the first byte of every record is the deletion flag
+        fields = dict()
+        offset = 1
+        while True:
+            descriptor = dbf.read(32)
+            if descriptor[:1] == b'\r':
+                break
+
+            name = descriptor[:11].split(b'\x00')[0].decode('ascii')
+            length = struct.unpack('<B', descriptor[16:17])[0]
+            fields[name] = (offset, length)
+            offset += length
+
+        dtype = numpy.dtype({
+            'names': ['deleted'] + columns,
+            'formats': ['S1'] + ['S{}'.format(fields[c][1]) for c in columns],
+            'offsets': [0] + [fields[c][0] for c in columns],
+            'itemsize': rec_len
+        })
+
+    if not rec_count:
+        return {c: numpy.array([], dtype=dtype[c]) for c in columns}
+
+    records = numpy.memmap(dbf_path, dtype=dtype, mode='r',
+                           offset=header_len, shape=(rec_count,))
+
+    chunks = {c: list() for c in columns}
+    for start in range(0, rec_count, DBF_CHUNK):
+        chunk = records[start:start + DBF_CHUNK]
+        deleted = numpy.array(chunk['deleted'] == b'*')
+
+        for c in columns:
+            values = numpy.array(numpy.char.strip(chunk[c]))
+            if drop_deleted:
+                values = values[~deleted]
+            else:
+                values[deleted] = ''
+            chunks[c].append(values)
+
+    # release the mapping so the file isn't held open
+    del records, chunk
+
+    return {c: numpy.concatenate(chunks[c]) for c in columns}
+
+
+def get_spatial_table_from_db(engine, table, fields, geom_col='geom',
+                              envelope=CENSUS_ENVELOPE, srid=CENSUS_SRID):
+    """Fetch the rows of the supplied table that intersect the envelope
+    (min x, min y, max x, max y) as features with shapely geometries.
+    Geometries are returned from the database as wkb and the results are
+    streamed in batches so that the full result set and its geoalchemy
+    objects are never held in memory at once"""
 
     session_maker = sessionmaker(bind=engine)
     session = session_maker()
 
-    fields.insert(0, geom_col)
+    geom_obj = getattr(table, geom_col)
     field_objs = [getattr(table, f) for f in fields]
 
-    results = (
-        session.query(*field_objs).
-        filter(getattr(table, geom_col).intersects(
-            func.ST_MakeEnvelope(7469314, 452285, 7891194, 781860, 2913))).
-        all()
+    query = (
+        session.query(func.ST_AsBinary(geom_obj), *field_objs).
+        filter(geom_obj.intersects(
+            func.ST_MakeEnvelope(*(tuple(envelope) + (srid,))))).
+        yield_per(FETCH_SIZE)
     )
 
     features = dict()
-    for i, t in enumerate(results):
-        fields = t._asdict()
-        geom = mapping(to_shape(fields.pop(geom_col)))
-        features[i] = dict(geometry=geom, properties=fields)
+    for i, row in enumerate(query):
+        geom = wkb.loads(bytes(row[0]))
+        properties = dict(zip(fields, row[1:]))
+        features[i] = dict(geometry=geom, properties=properties)
 
+    session.close()
     return features
 
 
@@ -149,47 +627,112 @@ def generate_spatial_index(features):
     return spatial_ix
 
 
-def spatial_join(target_feats, join_feats, s_index):
-    """"""
-
-    join_mapping = dict()
-
-    for t_fid, t_feat in target_feats.items():
-        t_geom = shape(t_feat['geometry'])
-
-        for j_fid in s_index.intersection(t_geom.bounds):
-            j_geom = shape(join_feats[j_fid]['geometry'])
-            if t_geom.intersects(j_geom):
-                if t_fid not in join_mapping:
-                    join_mapping[t_fid] = j_fid
-                else:
-                    print 'The address point with fid {} is being reported ' \
-                          'as being a part of more than one census unit ' \
-                          'which should not be possible, examine the code' \
-                          'and data for issues'.format(t_fid)
-                    exit()
-
-    return join_mapping
-
-
-def write_census_pt_counts_to_csv():
-    """"""
-
-    census_count = defaultdict(int)
-    with fiona.open(CENSUS_PTS) as census_pts:
-        for feat in census_pts:
-            bg = feat['properties']['bg']
-            census_count[bg] += 1
-
-            tract = feat['properties']['tract']
-            census_count[tract] += 1
+def spatial_join(t_fids, xs, ys, join_feats, s_index,
+                 report_unmatched=True):
+    """Assign each target point, supplied as arrays of fids and x and y
+    coordinates, to the join polygon that it falls within.
+    The points are held in numpy arrays sorted on x so that the points in
+    each polygon's bounding box can be found with a binary search and the
+    polygon is then tested against all of those points in one vectorized
+    call, points on its boundary are picked up with a second vectorized
+    test.  Only points that intersect more than one polygon are tested
+    individually against the candidates from the spatial index.
+
+    An array the length of the targets holding the fid of the matched join
+    feature (-1 where there isn't exactly one match) and a dictionary of
+    the unresolved target fids mapped to the list of join fids that they
+    intersect are returned, points that intersect no polygon are left out
+    of the dictionary if 'report_unmatched' is False"""
+
+    x_order = numpy.argsort(xs)
+    sorted_xs = xs[x_order]
+
+    join_ix = numpy.full(len(t_fids), -1, dtype=int)
+    match_count = numpy.zeros(len(t_fids), dtype=int)
+    join_geoms = dict()
+
+    for j_fid, j_feat in join_feats.items():
+        j_geom = j_feat['geometry']
+        if not isinstance(j_geom, BaseGeometry):
+            j_geom = shape(j_geom)
+        join_geoms[j_fid] = j_geom
+
+        min_x, min_y, max_x, max_y = j_geom.bounds
+        lo = numpy.searchsorted(sorted_xs, min_x, side='left')
+        hi = numpy.searchsorted(sorted_xs, max_x, side='right')
+        candidates = x_order[lo:hi]
+        candidates = candidates[
+            (ys[candidates] >= min_y) & (ys[candidates] <= max_y)]
+        if not candidates.size:
+            continue
+
+        inside = vectorized.contains(j_geom, xs[candidates], ys[candidates])
+        outside = candidates[~inside]
+        on_edge = vectorized.touches(j_geom, xs[outside], ys[outside])
+        matches = numpy.concatenate((candidates[inside], outside[on_edge]))
+        join_ix[matches] = j_fid
+        match_count[matches] += 1
+
+    problems = dict()
+    if report_unmatched:
+        for i in numpy.flatnonzero(match_count == 0):
+            problems[t_fids[i].item()] = list()
+
+    for i in numpy.flatnonzero(match_count > 1):
+        pt = Point(xs[i], ys[i])
+        problems[t_fids[i].item()] = sorted(
+            j for j in s_index.intersection(pt.bounds)
+            if join_geoms[j].intersects(pt))
+
+    join_ix[match_count != 1] = -1
+    return join_ix, problems
+
+
+def write_census_pt_counts_to_csv(census_count, layers, wide=False):
+    """Write the residence point counts tallied by
+    create_census_address_points.  The default long format has a row for
+    each unit of each layer, with a column naming the layer if any zone
+    layers were joined, the wide format has a row for every distinct
+    combination of units with a column per layer"""
+
+    if wide:
+        with open(POINTS_COUNT, 'wb') as pt_count_csv:
+            pt_writer = csv.writer(pt_count_csv)
+            header = tuple(layers) + ('residence point count',)
+            pt_writer.writerow(header)
+            for units, count in sorted(census_count.items()):
+                pt_writer.writerow(encode_row(units + (count,)))
+        return
+
+    layer_count = defaultdict(int)
+    for units, count in census_count.items():
+        for layer, unit_id in zip(layers, units):
+            if unit_id:
+                layer_count[(layer, unit_id)] += count
+
+    # census geoids identify their level by their length, zone ids don't
+    # so the layer is only written out when there are zones
+    has_zones = any(layer not in GEOID_LENGTHS for layer in layers)
 
     with open(POINTS_COUNT, 'wb') as pt_count_csv:
         pt_writer = csv.writer(pt_count_csv)
         header = ('geoid', 'residence point count')
+        if has_zones:
+            header = ('layer',) + header
         pt_writer.writerow(header)
-        for geoid, count in census_count.items():
-            pt_writer.writerow((geoid, count))
+
+        for (layer, unit_id), count in sorted(layer_count.items()):
+            row = (unit_id, count)
+            if has_zones:
+                row = (layer,) + row
+            pt_writer.writerow(encode_row(row))
+
+
+def encode_row(row):
+    """The python 2 csv module can't write non-ascii unicode so encode
+    any unicode values as utf-8"""
+
+    return [v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
 
 
 def process_postgres_options(args=None):
@@ -225,6 +768,40 @@ def process_postgres_options(args=None):
         help='postgres password for supplied user, if PGPASSWORD environment'
              'variable is set it will be read from that setting'
     )
+    parser.add_argument(
+        '-e', '--envelope',
+        nargs=4,
+        type=float,
+        default=CENSUS_ENVELOPE,
+        metavar=('MIN_X', 'MIN_Y', 'MAX_X', 'MAX_Y'),
+        help='extent in oregon state plane north (epsg:{}) that census '
+             'geometries are fetched within'.format(CENSUS_SRID)
+    )
+    parser.add_argument(
+        '-z', '--zone_layer',
+        nargs=3,
+        action='append',
+        dest='zones',
+        metavar=('NAME', 'PATH', 'ID_FIELD'),
+        help='polygon shapefile that address points are assigned to in '
+             'addition to the census units, may be supplied more than '
+             'once, the name must be 10 characters or less as it becomes '
+             'a shapefile field, no zones are joined by default'
+    )
+    parser.add_argument(
+        '-w', '--wide',
+        action='store_true',
+        help='write counts with a row for each distinct combination of '
+             'census units and zones rather than a row per unit'
+    )
+    parser.add_argument(
+        '-j', '--processes',
+        type=int,
+        default=1,
+        help='number of processes that address points are classified and '
+             'joined with, if greater than one the points are split into '
+             'spatial tiles that are handled in parallel'
+    )
 
     options = parser.parse_args(args)
     return options
@@ -237,8 +814,9 @@ def main():
     args = sys.argv[1:]
     pg = process_postgres_options(args)
 
-    create_census_address_points()
-    write_census_pt_counts_to_csv()
+    census_count, layers = create_census_address_points(
+        processes=pg.processes, zones=pg.zones or ZONE_LAYERS)
+    write_census_pt_counts_to_csv(census_count, layers, pg.wide)
 
 
 if __name__ == '__main__':
@@ -1,21 +1,42 @@
+import os
 import sys
 import argparse
-from os.path import join
+from os.path import dirname, exists, join
 from collections import OrderedDict
+from multiprocessing import Pool
 
 import fiona
+import numpy
 import psycopg2
 from fiona import crs
 from shapely import wkb
 from shapely.ops import unary_union
-from shapely.geometry import mapping, shape
+from shapely.geometry import box, mapping, shape, MultiPolygon, Point
+from shapely.prepared import prep
 from psycopg2.extras import RealDictCursor
-from arcpy import da, env, analysis, management
+from rasterio.features import shapes
+from rasterio.transform import from_origin
+from rtree import index
+from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
 
 dbname = 'trimet'
 host = 'maps6.trimet.org'
 
-env.overwriteOutput = True
+# number of features handed to each writerecords call
+write_batch = 5000
+
+# shapefile field names are limited to 10 characters so 'vend_dist9' is
+# the last of the nth nearest vendor fields that fits
+max_nearest = 9
+
+# when deserts are built in parallel their extent is split into a grid
+# with this many tiles per side
+tile_grid = 6
+
+# size in feet of the cells of the grid deserts are computed on in raster
+# mode, halving it quadruples memory use
+raster_cell_size = 100
 
 project_dir = '//gisstore/gis/PUBLIC/GIS_Projects/eFare_Project'
 deserts_dir = join(project_dir, 'Vendor_Deserts')
@@ -26,125 +47,189 @@ rc_vendors = join(analysis_dir, 'shp', 'rc_vendors_ospn_2015_05.shp')
 current_stops = join(deserts_dir, 'shp', 'stops.shp')
 master_stops = join(analysis_dir, 'shp', 'master_efare_stops.shp')
 desert_gaps = join(deserts_dir, 'shp', 'desert_gaps.shp')
+raster_gaps = join(deserts_dir, 'shp', 'desert_gaps_raster.shp')
+sweep_gpkg = join(deserts_dir, 'gpkg', 'desert_gaps_sweep.gpkg')
 t6_block_groups = join(third_mile_dir, 'shp', 'min_pov_acs5_2012.shp')
 t6_desert_mask = join(deserts_dir, 'shp', 't6_desert_mask.shp')
 t6_desert_feats = join(deserts_dir, 'shp', 't6_desert_features.shp')
 
 
-def get_current_stops():
-    """"""
+def get_current_stops(stops_path=current_stops):
+    """Export the current stops from postgis to a shapefile, or to a
+    geopackage if the path ends in .gpkg.  Rows are streamed through a
+    named (server side) cursor a batch at a time with the geometry fetched
+    as binary wkb, so the full table is never held in memory"""
 
     db_template = 'dbname={0} user={1} host={2} password={3}'
     db_str = db_template.format(dbname, user, host, password)
     conn = psycopg2.connect(db_str)
-    cur = conn.cursor()
 
     q_params = {
         'schema': 'current',
         'stop_table': 'stop'
     }
 
-    q = """SELECT geom, id, name, type, begin_date,
+    # the geometry type and srid come from the postgis catalog rather
+    # than being read off of a row of the table
+    q1 = """SELECT type as geom_type, srid as epsg
+            from geometry_columns
+            where f_table_schema = %(schema)s
+              and f_table_name = %(stop_table)s
+              and f_geometry_column = 'geom'"""
+
+    dict_cur = conn.cursor(cursor_factory=RealDictCursor)
+    dict_cur.execute(q1, q_params)
+    pg_meta = dict_cur.fetchone()
+    dict_cur.close()
+
+    q = """SELECT ST_AsBinary(geom) as geom, id, name, type, begin_date,
              end_date, street_direction as street_dir
            from {schema}.{stop_table}"""
 
+    cur = conn.cursor(name='current_stops')
+    cur.itersize = write_batch
     cur.execute(q.format(**q_params))
-    fields = [desc[0] for desc in cur.description]
 
-    stops_list = []
-    for row in cur.fetchall():
-        s = OrderedDict(zip(fields, row))
-        s['geom'] = wkb.loads(s['geom'], hex=True)
-        stops_list.append(s)
+    rows = cur.fetchmany(write_batch)
+    fields = [desc[0] for desc in cur.description][1:]
 
     # setting up a mapping between the field names and their values'
     # python field types
-    stop = OrderedDict(
-        [(k, v) for k, v in stops_list[0].items() if k != 'geom'])
-    fields = OrderedDict([(k, type(v).__name__) for k, v in stop.items()])
-
-    # get the rest of table's metadata from postgis
-    q1 = """SELECT GeometryType(geom) as geom_type,
-              ST_SRID(geom) as epsg
-            from {schema}.{stop_table}
-            limit 1"""
-
-    dict_cur = conn.cursor(cursor_factory=RealDictCursor)
-    dict_cur.execute(q1.format(**q_params))
-    pg_meta = dict_cur.fetchone()
-
-    conn.close()
+    field_types = OrderedDict(
+        [(k, type(v).__name__) for k, v in zip(fields, rows[0][1:])])
 
     # don't forget that fields names must be 10 characters or less
     # for a shapefile and fiona has basically no error messages
     metadata = {
         'crs': crs.from_epsg(pg_meta['epsg']),
-        'driver': 'ESRI Shapefile',
+        'driver': 'GPKG' if stops_path.endswith('.gpkg') else 'ESRI Shapefile',
         'schema': {
             'geometry': pg_meta['geom_type'].title(),
-            'properties': fields
+            'properties': field_types
         }
     }
 
-    with fiona.open(current_stops, 'w', **metadata) as stops_shp:
-        for s in stops_list:
-            s_dict = {'geometry': mapping(s.pop('geom'))}
-            s_dict['properties'] = s
+    with fiona.open(stops_path, 'w', **metadata) as stops_shp:
+        while rows:
+            geoms = decode_wkb_batch([r[0] for r in rows])
+            stops_shp.writerecords(
+                [{'geometry': g, 'properties': OrderedDict(zip(fields, r[1:]))}
+                 for g, r in zip(geoms, rows)])
+            rows = cur.fetchmany(write_batch)
 
-            stops_shp.write(s_dict)
+    cur.close()
+    conn.close()
 
 
-def add_nearest_vendor_distance(stops):
-    """Non-open source function, booooooooooo!!!"""
+def decode_wkb_batch(wkbs):
+    """Convert a list of wkb geometries to geojson like mappings.  If all
+    of them are little endian 2d points, by far the most common case, the
+    coordinates are read out of the buffers in a single numpy call,
+    otherwise each is parsed with shapely"""
 
-    stop_vend_tbl = join(deserts_dir, 'shp', 'stop_vend_near_tbl.dbf')
-    analysis.GenerateNearTable(stops, rc_vendors, stop_vend_tbl)
+    wkbs = [bytes(w) for w in wkbs]
+    point_wkb = numpy.dtype(
+        [('order', 'u1'), ('type', '<u4'), ('x', '<f8'), ('y', '<f8')])
 
-    dist_dict = {}
-    tbl_fields = ['IN_FID', 'NEAR_DIST']
-    with da.SearchCursor(stop_vend_tbl, tbl_fields) as s_cursor:
-        for fid, dist in s_cursor:
-            dist_dict[fid] = dist
+    if all(len(w) == point_wkb.itemsize for w in wkbs):
+        points = numpy.frombuffer(b''.join(wkbs), dtype=point_wkb)
+        if (points['order'] == 1).all() and (points['type'] == 1).all():
+            return [{'type': 'Point', 'coordinates': (x, y)}
+                    for x, y in zip(points['x'].tolist(),
+                                    points['y'].tolist())]
 
-    dist_field, dbl_type = 'vend_dist', 'DOUBLE'
-    management.AddField(stops, dist_field, dbl_type)
+    return [mapping(wkb.loads(w)) for w in wkbs]
 
-    stop_fields = ['OID@', dist_field]
-    with da.UpdateCursor(stops, stop_fields) as u_cursor:
-        for oid, dist in u_cursor:
-            dist = dist_dict[oid]
-            u_cursor.updateRow((oid, dist))
 
+def add_nearest_vendor_distance(stops, dist_stops=None, k=1):
+    """Add the distance to the nearest vendor ('vend_dist') and that
+    vendor's fid ('vend_id') to each stop.  A kd-tree is built over the
+    vendor points and all stops are queried against it at once.  If k is
+    greater than one the distances and fids of the 2nd through kth
+    nearest vendors are added as well ('vend_dist2', 'vend_id2', etc), k
+    can be at most max_nearest.  fiona can't modify a shapefile in place
+    so the stops are written to 'dist_stops', or back over the input if
+    that isn't supplied.  Arrays of the distances and vendor fids, n stops
+    x k, are returned"""
 
-def generate_deserts_feature(stops, desert_dist, t6=None):
-    """"""
+    with fiona.open(rc_vendors) as vendors:
+        vend_ids = list()
+        vend_coords = list()
+        for fid, feat in vendors.items():
+            vend_ids.append(fid)
+            vend_coords.append(feat['geometry']['coordinates'][:2])
+
+    with fiona.open(stops) as stops_shp:
+        metadata = stops_shp.meta.copy()
+        stop_feats = list(stops_shp)
+
+    if not vend_ids:
+        raise ValueError('no vendors found in: {}'.format(rc_vendors))
+    if not 1 <= k <= max_nearest:
+        raise ValueError('k must be between 1 and {}, the field names of '
+                         'further vendors would exceed the shapefile '
+                         'limit'.format(max_nearest))
+
+    # there can't be more nearest vendors than there are vendors
+    k = min(k, len(vend_ids))
+
+    stop_coords = [f['geometry']['coordinates'][:2] for f in stop_feats]
+    vend_tree = cKDTree(numpy.array(vend_coords, dtype=float))
+    dists, near_ix = vend_tree.query(
+        numpy.array(stop_coords, dtype=float).reshape(-1, 2), k=k)
+
+    dists = dists.reshape(len(stop_feats), k)
+    near_ids = numpy.array(vend_ids)[near_ix.reshape(len(stop_feats), k)]
+
+    dist_fields = ['vend_dist'] + \
+        ['vend_dist{}'.format(n) for n in range(2, k + 1)]
+    id_fields = ['vend_id'] + ['vend_id{}'.format(n) for n in range(2, k + 1)]
+
+    fields = metadata['schema']['properties']
+    for dist_field, id_field in zip(dist_fields, id_fields):
+        fields[dist_field] = 'float'
+        fields[id_field] = 'int'
+
+    with fiona.open(dist_stops or stops, 'w', **metadata) as out_stops:
+        batch = list()
+        for feat, stop_dists, stop_ids in zip(stop_feats, dists, near_ids):
+            props = feat['properties']
+            for n in range(k):
+                props[dist_fields[n]] = float(stop_dists[n])
+                props[id_fields[n]] = int(stop_ids[n])
+
+            batch.append(feat)
+            if len(batch) >= write_batch:
+                out_stops.writerecords(batch)
+                batch = list()
+
+        out_stops.writerecords(batch)
+
+    return dists, near_ids
+
+
+def generate_deserts_feature(stops, desert_dist, t6=None, processes=1):
+    """Build the vendor desert, the area within 'desert_dist' of a stop
+    that is farther than that from any vendor, and write its inverse
+    within the county bounding box as a mask.  If more than one process
+    is requested the buffering and unions are done by tile in a pool"""
 
     b_box = get_pg_table_b_box('load.county')
 
-    stops_buffs = []
     with fiona.open(stops) as dist_stops:
         metadata = dist_stops.meta.copy()
+        stop_xy = [f['geometry']['coordinates'][:2] for f in dist_stops
+                   if f['properties']['vend_dist'] > desert_dist]
 
-        for feat in dist_stops:
-            geom = shape(feat['geometry'])
-            fields = feat['properties']
-            dist = fields['vend_dist']
-
-            if dist > desert_dist:
-                buff = geom.buffer(desert_dist)
-                stops_buffs.append(buff)
-
-    desert_area = unary_union(stops_buffs)
-
-    vendor_buffs = []
     with fiona.open(rc_vendors) as vendors:
-        for feat in vendors:
-            geom = shape(feat['geometry'])
-            buff = geom.buffer(desert_dist)
-            vendor_buffs.append(buff)
+        vendor_xy = [f['geometry']['coordinates'][:2] for f in vendors]
+
+    if processes > 1:
+        desert_trim = get_tiled_desert_area(
+            stop_xy, vendor_xy, desert_dist, processes)
+    else:
+        desert_trim = get_desert_area(stop_xy, vendor_xy, desert_dist)
 
-    vendor_area = unary_union(vendor_buffs)
-    desert_trim = desert_area.difference(vendor_area)
     desert_mask = b_box.difference(desert_trim)
 
     schema = metadata['schema']
@@ -165,6 +250,247 @@ def generate_deserts_feature(stops, desert_dist, t6=None):
         gaps_shp.write(feat)
 
 
+def get_desert_area(stop_xy, vendor_xy, desert_dist, clip_geom=None):
+    """Union the buffers of the supplied stop coordinates and remove the
+    union of the vendor buffers from it, if a clip geometry is supplied
+    the result is trimmed to it"""
+
+    stops_buffs = [Point(xy).buffer(desert_dist) for xy in stop_xy]
+    desert_area = unary_union(stops_buffs)
+
+    vendor_buffs = [Point(xy).buffer(desert_dist) for xy in vendor_xy]
+    vendor_area = unary_union(vendor_buffs)
+
+    desert_trim = desert_area.difference(vendor_area)
+    if clip_geom is not None:
+        desert_trim = desert_trim.intersection(clip_geom)
+
+    return desert_trim
+
+
+def get_tiled_desert_area(stop_xy, vendor_xy, desert_dist, processes,
+                          grid=tile_grid):
+    """Split the extent of the stop buffers into a grid and build the
+    desert area of each tile in a process pool.  Each tile is sent only
+    the stops and vendors whose buffers reach it and clips its result to
+    the tile, the tile pieces are then stitched back together with a
+    union that dissolves the seams between them"""
+
+    stop_xy = numpy.array(stop_xy, dtype=float).reshape(-1, 2)
+    vendor_xy = numpy.array(vendor_xy, dtype=float).reshape(-1, 2)
+    if not len(stop_xy):
+        return get_desert_area([], [], desert_dist)
+
+    min_x, min_y = stop_xy.min(axis=0) - desert_dist
+    max_x, max_y = stop_xy.max(axis=0) + desert_dist
+    x_edges = numpy.linspace(min_x, max_x, grid + 1)
+    y_edges = numpy.linspace(min_y, max_y, grid + 1)
+
+    tiles = list()
+    for i in range(grid):
+        for j in range(grid):
+            tile = (x_edges[i], y_edges[j], x_edges[i + 1], y_edges[j + 1])
+            tile_stops = points_near_tile(stop_xy, tile, desert_dist)
+            if not len(tile_stops):
+                continue
+
+            tile_vendors = points_near_tile(vendor_xy, tile, desert_dist)
+            tiles.append((tile, tile_stops.tolist(),
+                          tile_vendors.tolist(), desert_dist))
+
+    pool = Pool(processes)
+    tile_areas = pool.map(get_tile_desert_area, tiles, chunksize=1)
+    pool.close()
+    pool.join()
+
+    return unary_union([wkb.loads(area) for area in tile_areas])
+
+
+def points_near_tile(xy, tile, dist):
+    """Return the coordinates whose buffer of 'dist' may reach the tile"""
+
+    min_x, min_y, max_x, max_y = tile
+    near = (xy[:, 0] >= min_x - dist) & (xy[:, 0] <= max_x + dist) & \
+           (xy[:, 1] >= min_y - dist) & (xy[:, 1] <= max_y + dist)
+
+    return xy[near]
+
+
+def get_tile_desert_area(tile_args):
+    """Pool worker that builds the desert area of a single tile, the
+    result is handed back as wkb"""
+
+    tile, tile_stops, tile_vendors, desert_dist = tile_args
+    desert_area = get_desert_area(
+        tile_stops, tile_vendors, desert_dist, box(*tile))
+
+    return desert_area.wkb
+
+
+def generate_desert_sweep(stops, desert_dists):
+    """Build the desert mask for each of the supplied distances in one run,
+    reusing work across them, and write each mask as a layer of a single
+    geopackage.
+
+    A buffer of a union is the union of the buffers, so every stop and
+    vendor is only buffered once, by the smallest distance, and larger
+    distances are reached by buffering those unions outward by the
+    difference.  Vendors are the same for every distance, so their union
+    is built a single time.  The stops in a desert shrink as the distance
+    grows, so they're grouped into bands by 'vend_dist' between successive
+    distances.  Each band is unioned once and the stop area for a distance
+    is the running union of its band and every band above it."""
+
+    desert_dists = sorted(desert_dists)
+    base_dist = desert_dists[0]
+    b_box = get_pg_table_b_box('load.county')
+
+    with fiona.open(stops) as dist_stops:
+        metadata = dist_stops.meta.copy()
+        band_buffs = [list() for d in desert_dists]
+        for feat in dist_stops:
+            vend_dist = feat['properties']['vend_dist']
+            band = numpy.searchsorted(desert_dists, vend_dist) - 1
+            if band >= 0:
+                buff = shape(feat['geometry']).buffer(base_dist)
+                band_buffs[band].append(buff)
+
+    with fiona.open(rc_vendors) as vendors:
+        vendor_area = unary_union(
+            [shape(f['geometry']).buffer(base_dist) for f in vendors])
+
+    # the stops in a desert at a given distance are those in its band
+    # and all bands above it, so the unions are accumulated from the top
+    stop_areas = list()
+    stop_area = unary_union([])
+    for buffs in reversed(band_buffs):
+        stop_area = unary_union([stop_area] + buffs)
+        stop_areas.insert(0, stop_area)
+
+    if not exists(dirname(sweep_gpkg)):
+        os.makedirs(dirname(sweep_gpkg))
+
+    metadata['driver'] = 'GPKG'
+    schema = metadata['schema']
+    schema['geometry'] = 'MultiPolygon'
+    schema['properties'] = OrderedDict([('id', 'int'), ('desert_dst', 'int')])
+
+    for i, (desert_dist, stop_area) in enumerate(
+            zip(desert_dists, stop_areas), 1):
+        grow = desert_dist - base_dist
+        if grow:
+            stop_area = stop_area.buffer(grow)
+            dist_vendor_area = vendor_area.buffer(grow)
+        else:
+            dist_vendor_area = vendor_area
+
+        desert_trim = stop_area.difference(dist_vendor_area)
+        desert_mask = b_box.difference(desert_trim)
+        if desert_mask.geom_type == 'Polygon':
+            desert_mask = MultiPolygon([desert_mask])
+
+        layer = 'desert_gaps_{}'.format(int(desert_dist))
+        with fiona.open(sweep_gpkg, 'w', layer=layer, **metadata) as gaps:
+            feat = {
+                'geometry': mapping(desert_mask),
+                'properties': {
+                    'id': i,
+                    'desert_dst': desert_dist
+                }
+            }
+            gaps.write(feat)
+
+
+def generate_raster_deserts(stops, desert_dists, cell_size=raster_cell_size):
+    """Raster alternative to generate_deserts_feature that handles any
+    number of desert distances at once.  Vendors and stops are burned into
+    a grid covering the county bounding box and euclidean distance
+    transforms give the distance from every cell to the nearest vendor
+    and to the nearest desert stop.  The desert for each distance is then
+    just a threshold of those grids and only that final mask is turned
+    into polygons.  A mask feature for each distance is written to a
+    single shapefile.  Distances are measured between cell centers so
+    the edges of the result are accurate to about a cell"""
+
+    b_box = get_pg_table_b_box('load.county')
+
+    # the grid is padded by the largest desert distance so that vendors
+    # and stops just outside of the bounding box still count toward the
+    # cells near its edge, the masks are clipped back to the box
+    pad = max(desert_dists)
+    min_x, min_y, max_x, max_y = b_box.bounds
+    min_x, min_y = min_x - pad, min_y - pad
+    max_x, max_y = max_x + pad, max_y + pad
+    cols = int(numpy.ceil((max_x - min_x) / cell_size))
+    rows = int(numpy.ceil((max_y - min_y) / cell_size))
+    grid = (rows, cols, min_x, max_y, cell_size)
+    transform = from_origin(min_x, max_y, cell_size, cell_size)
+
+    with fiona.open(stops) as dist_stops:
+        metadata = dist_stops.meta.copy()
+        stop_xy = list()
+        stop_vend_dist = list()
+        for feat in dist_stops:
+            stop_xy.append(feat['geometry']['coordinates'][:2])
+            stop_vend_dist.append(feat['properties']['vend_dist'])
+
+    stop_xy = numpy.array(stop_xy, dtype=float).reshape(-1, 2)
+    stop_vend_dist = numpy.array(stop_vend_dist, dtype=float)
+
+    with fiona.open(rc_vendors) as vendors:
+        vendor_xy = [f['geometry']['coordinates'][:2] for f in vendors]
+
+    vendor_grid = get_distance_grid(vendor_xy, grid)
+
+    schema = metadata['schema']
+    schema['geometry'] = 'MultiPolygon'
+    schema['properties'] = OrderedDict([('id', 'int'), ('desert_dst', 'int')])
+
+    with fiona.open(raster_gaps, 'w', **metadata) as gaps_shp:
+        for i, desert_dist in enumerate(sorted(desert_dists), 1):
+            desert_stops = stop_xy[stop_vend_dist > desert_dist]
+            stop_grid = get_distance_grid(desert_stops, grid)
+            desert = (stop_grid <= desert_dist) & (vendor_grid > desert_dist)
+
+            desert_polys = [shape(geom) for geom, value in shapes(
+                desert.astype(numpy.uint8), mask=desert, transform=transform)]
+            desert_area = unary_union(desert_polys).intersection(b_box)
+            desert_mask = b_box.difference(desert_area)
+            if desert_mask.geom_type == 'Polygon':
+                desert_mask = MultiPolygon([desert_mask])
+
+            feat = {
+                'geometry': mapping(desert_mask),
+                'properties': {
+                    'id': i,
+                    'desert_dst': desert_dist
+                }
+            }
+            gaps_shp.write(feat)
+
+
+def get_distance_grid(xy, grid):
+    """Return an array holding the distance from the center of each cell
+    of the grid, a (rows, cols, min x, max y, cell size) tuple, to the
+    nearest of the supplied points.  Points off the grid are ignored"""
+
+    rows, cols, min_x, max_y, cell_size = grid
+    xy = numpy.array(xy, dtype=float).reshape(-1, 2)
+    col_ix = numpy.floor((xy[:, 0] - min_x) / cell_size).astype(int)
+    row_ix = numpy.floor((max_y - xy[:, 1]) / cell_size).astype(int)
+    on_grid = (col_ix >= 0) & (col_ix < cols) & \
+              (row_ix >= 0) & (row_ix < rows)
+
+    if not on_grid.any():
+        return numpy.full((rows, cols), numpy.inf)
+
+    # the distance transform measures the distance to the nearest zero
+    not_point = numpy.ones((rows, cols), dtype=bool)
+    not_point[row_ix[on_grid], col_ix[on_grid]] = False
+
+    return distance_transform_edt(not_point, sampling=cell_size)
+
+
 def get_pg_table_b_box(table):
     """"""
 
@@ -185,28 +511,46 @@ def get_pg_table_b_box(table):
 
 
 def create_t6_deserts(desert_geom, b_box, mask_metadata):
-    """"""
-
-    geom_list = list()
+    """Clip the title vi block groups to the desert and write them along
+    with a mask of the title vi desert.  The desert is prepared once for
+    the intersects test and its parts are indexed so each block group is
+    only clipped against the parts that overlap it.  The clipped block
+    groups already are the title vi desert, so their union is used rather
+    than intersecting the union of the block groups with the desert"""
+
+    desert_prep = prep(desert_geom)
+    desert_parts = list(getattr(desert_geom, 'geoms', [desert_geom]))
+    parts_ix = index.Index()
+    for i, part in enumerate(desert_parts):
+        parts_ix.insert(i, part.bounds)
+
+    clip_list = list()
     with fiona.open(t6_block_groups) as block_groups:
         t6_metadata = block_groups.meta.copy()
 
         with fiona.open(t6_desert_feats, 'w', **t6_metadata) as t6_deserts:
             for bg in block_groups:
-                geom = shape(bg['geometry'])
                 props = bg['properties']
 
                 # 'neither' is misspelled in dataset so (sic)
-                if props['min_pov'] != 'niether' and \
-                        geom.intersects(desert_geom):
-                    geom_list.append(geom)
+                if props['min_pov'] == 'niether':
+                    continue
+
+                geom = shape(bg['geometry'])
+                if desert_prep.intersects(geom):
+                    part_clips = [
+                        geom.intersection(desert_parts[i])
+                        for i in parts_ix.intersection(geom.bounds)]
+                    if len(part_clips) == 1:
+                        new_geom = part_clips[0]
+                    else:
+                        new_geom = unary_union(part_clips)
+                    clip_list.append(new_geom)
 
-                    new_geom = geom.intersection(desert_geom)
                     bg['geometry'] = mapping(new_geom)
                     t6_deserts.write(bg)
 
-    t6_geom = unary_union(geom_list)
-    t6_desert_geom = t6_geom.intersection(desert_geom)
+    t6_desert_geom = unary_union(clip_list)
     t6_mask_geom = b_box.difference(t6_desert_geom)
 
     with fiona.open(t6_desert_mask, 'w', **mask_metadata) as t6_mask:
@@ -239,6 +583,13 @@ def process_options(arglist=None):
         required=True,
         help='password for postgres database "trimet"'
     )
+    parser.add_argument(
+        '-j', '--processes',
+        type=int,
+        default=1,
+        help='number of processes used to build the desert geometry, if '
+             'greater than one the work is split into tiles'
+    )
 
     options = parser.parse_args(arglist)
     return options
@@ -254,7 +605,10 @@ def main():
     password = options.password
 
     # get_current_stops()
-    generate_deserts_feature(master_stops, 5280, t6=True)
+    # generate_raster_deserts(master_stops, [1320, 2640, 3960, 5280])
+    # generate_desert_sweep(master_stops, [1320, 2640, 3960, 5280])
+    generate_deserts_feature(
+        master_stops, 5280, t6=True, processes=options.processes)
 
 
 if __name__ == '__main__':
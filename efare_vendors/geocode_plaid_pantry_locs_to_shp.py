@@ -3,13 +3,12 @@ import sys
 import argparse
 import requests
 from os.path import join
-from functools import partial
 from collections import OrderedDict
 
 import fiona
+import numpy
 import pyproj
 from fiona import crs
-from shapely.ops import transform
 from shapely.geometry import mapping, Point
 
 home = 'G:/PUBLIC/GIS_Projects/eFare_Project/Vendor_Analysis'
@@ -18,6 +17,9 @@ plaid_shp_path = join(home, 'shp', 'plaid_pantry_locations.shp')
 ready_credit_path = join(home, 'shp', 'rc_vendors_ospn_2015_05.shp')
 plaid_rc_path = join(home, 'shp', 'rc_and_plaid_locations.shp')
 
+# pyproj transformers are cached by (source, destination) epsg pair
+transformers = dict()
+
 
 def create_plaid_pantry_shp():
     """"""
@@ -40,11 +42,11 @@ def create_plaid_pantry_shp():
                     [(n, 'str') for n in reader.fieldnames if n])
             }
         }
-        latlon2ospn = partial(
-            pyproj.transform,
-            pyproj.Proj(init='epsg:4326'),
-            pyproj.Proj(init='epsg:2913', preserve_units=True)
-        )
+        # features geocoded by google are in wgs84, they're set aside
+        # and reprojected to state plane together once all are found
+        wgs_feats = list()
+        wgs_lons = list()
+        wgs_lats = list()
 
         addr_template = '{num} {pre} {street}, {city}, {st} {zip}'
         for r in reader:
@@ -59,25 +61,61 @@ def create_plaid_pantry_shp():
                 print 'the rlis api halting geoprocessing until this'
                 print 'is resolved'
                 exit()
-            elif rsp:
+
+            feat = {
+                'geometry': None,
+                'properties': {k: v for k, v in r.items() if k}}
+            features.append(feat)
+
+            if rsp:
                 geom = Point(rsp['ORSP_x'], rsp['ORSP_y'])
+                feat['geometry'] = mapping(geom)
             else:
                 rsp = google_geocode(addr_str)
                 print rsp
-                geom_wgs84 = Point(rsp['lng'], rsp['lat'])
-                geom = transform(latlon2ospn, geom_wgs84)
-                print geom.x, geom.y
+                wgs_feats.append(feat)
+                wgs_lons.append(rsp['lng'])
+                wgs_lats.append(rsp['lat'])
 
-            feat = {
-                'geometry': mapping(geom),
-                'properties': {k: v for k, v in r.items() if k}}
-            features.append(feat)
+        xs, ys = transform_coordinates(wgs_lons, wgs_lats, 4326, 2913)
+        for feat, x, y in zip(wgs_feats, xs, ys):
+            print x, y
+            feat['geometry'] = mapping(Point(x, y))
 
     with fiona.open(plaid_shp_path, 'w', **metadata) as plaid_shp:
         for feat in features:
             plaid_shp.write(feat)
 
 
+def get_transformer(src_srs, dst_srs):
+    """Return the cached pyproj transformer between the two supplied epsg
+    codes, building it on first request.  pyproj assumes coordinates are
+    meters, but ospn is in feet, thus the 'preserve_units' parameter, see:
+    http://gis.stackexchange.com/questions/10209"""
+
+    key = (int(src_srs), int(dst_srs))
+    if key not in transformers:
+        transformers[key] = pyproj.Transformer.from_proj(
+            pyproj.Proj(init='epsg:{}'.format(key[0]), preserve_units=True),
+            pyproj.Proj(init='epsg:{}'.format(key[1]), preserve_units=True))
+
+    return transformers[key]
+
+
+def transform_coordinates(xs, ys, src_srs, dst_srs):
+    """Reproject sequences of x and y coordinates from the source to the
+    destination epsg in one call, numpy arrays of the transformed x and y
+    values are returned"""
+
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    if not xs.size:
+        return xs, ys
+
+    transformer = get_transformer(src_srs, dst_srs)
+    return transformer.transform(xs, ys)
+
+
 def rlis_geocode(addr_str):
     """Take an input address string, send it to the rlis api and return
     a dictionary that are the state plane coordinated for that address,
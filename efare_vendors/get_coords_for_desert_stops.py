@@ -1,12 +1,14 @@
 import csv
+from collections import OrderedDict
 from os.path import join
-from functools import partial
 
 import fiona
+import numpy
 import pyproj
 from rtree import index
-from shapely.ops import transform
-from shapely.geometry import shape
+from shapely import vectorized
+from shapely.geometry import shape, Point
+from shapely.prepared import prep
 
 home = '//gisstore/gis/PUBLIC/GIS_Projects/eFare_Project'
 deserts_dir = join(home, 'Vendor_Deserts')
@@ -21,21 +23,74 @@ cities = join(rlis_dir, 'BOUNDARY', 'cty_fill.shp')
 counties = join(rlis_dir, 'BOUNDARY', 'co_fill.shp')
 
 desert_stops_csv = join(deserts_dir, 'csv', 'desert_stops.csv')
+csv_fields = ['agency', 'stop_id', 'x', 'y', 'lat', 'lon',
+              'city/county', 'hood', 't6_status']
 
+# pyproj transformers are cached by (source, destination) epsg pair
+transformers = dict()
 
-def generate_spatial_index(features):
-    """"""
+
+def load_region_layer(regions, name_field):
+    """Read a polygon layer a single time, returning its geometries, the
+    value of the name field for each, prepared versions of the geometries
+    and an rtree index of their bounds"""
 
     # spatial index technique derived from this post:
     # http://gis.stackexchange.com/questions/120955
 
+    geoms = list()
+    names = list()
     spatial_ix = index.Index()
-    with fiona.open(features) as feats:
-        for fid, f in feats.items():
+    with fiona.open(regions) as reg:
+        for f in reg:
             geom = shape(f['geometry'])
-            spatial_ix.insert(fid, geom.bounds)
-
-    return spatial_ix
+            spatial_ix.insert(len(geoms), geom.bounds)
+            geoms.append(geom)
+            names.append(f['properties'][name_field])
+
+    prepared = [prep(g) for g in geoms]
+    return geoms, names, prepared, spatial_ix
+
+
+def find_intersecting_regions(xs, ys, region_layer):
+    """Return an array holding the name of the region that each of the
+    supplied points falls within (None if it isn't in any, the first
+    region wins where they overlap).  The points are sorted on x so those
+    in each region's bounding box can be found with a binary search and
+    then tested in one vectorized call, points on a region boundary aren't
+    contained by it so any left unmatched get an exact intersects test
+    against their index candidates"""
+
+    geoms, names, prepared, spatial_ix = region_layer
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    x_order = numpy.argsort(xs)
+    sorted_xs = xs[x_order]
+    region_ix = numpy.full(len(xs), -1, dtype=int)
+
+    for i, geom in enumerate(geoms):
+        min_x, min_y, max_x, max_y = geom.bounds
+        lo = numpy.searchsorted(sorted_xs, min_x, side='left')
+        hi = numpy.searchsorted(sorted_xs, max_x, side='right')
+        candidates = x_order[lo:hi]
+        candidates = candidates[
+            (ys[candidates] >= min_y) & (ys[candidates] <= max_y) &
+            (region_ix[candidates] == -1)]
+        if not candidates.size:
+            continue
+
+        inside = vectorized.contains(geom, xs[candidates], ys[candidates])
+        region_ix[candidates[inside]] = i
+
+    for pt_ix in numpy.flatnonzero(region_ix == -1):
+        pt_geom = Point(xs[pt_ix], ys[pt_ix])
+        for i in sorted(spatial_ix.intersection(pt_geom.bounds)):
+            if prepared[i].intersects(pt_geom):
+                region_ix[pt_ix] = i
+                break
+
+    region_names = numpy.array(names + [None], dtype=object)
+    return region_names[region_ix]
 
 
 def get_desert_stop_loc_info():
@@ -44,21 +99,6 @@ def get_desert_stop_loc_info():
     csv_rows = []
     retain = ['agency', 'stop_id']
 
-    cty_ix = generate_spatial_index(cities)
-    co_ix = generate_spatial_index(counties)
-    nbo_ix = generate_spatial_index(nbo_hoods)
-    t6_ix = generate_spatial_index(t6_block_groups)
-
-    # create object that reprojects oregon state plane geometry to wgs84
-    # pyproj assumes coordinates are meters, but ospn is in feet, thus
-    # the 'preserve_units' parameter is needed here, see link for details:
-    # http://gis.stackexchange.com/questions/10209
-    ospn2wgs84 = partial(
-        pyproj.transform,
-        pyproj.Proj(init='epsg:2913', preserve_units=True),
-        pyproj.Proj(init='epsg:4326')
-    )
-
     with fiona.open(master_stops) as stops:
         for row in stops:
             props = row['properties']
@@ -73,44 +113,68 @@ def get_desert_stop_loc_info():
                 props['x'] = geom.x
                 props['y'] = geom.y
 
-                geom_4326 = transform(ospn2wgs84, geom)
-                props['lat'] = geom_4326.y
-                props['lon'] = geom_4326.x
-
-                city = find_intersecting_region(
-                    geom, cities, cty_ix, 'CITYNAME')
-                county = find_intersecting_region(
-                    geom, counties, co_ix, 'COUNTY')
-                props['city/county'] = city or county + ' County'
-
-                props['hood'] = find_intersecting_region(
-                    geom, nbo_hoods, nbo_ix, 'NAME')
-                props['t6_status'] = find_intersecting_region(
-                    geom, t6_block_groups, t6_ix, 'min_pov')
-
                 csv_rows.append(props)
 
-    return csv_rows
-
-
-def find_intersecting_region(pt_geom, regions, regions_ix, name_field):
-    """"""
-
-    with fiona.open(regions) as reg:
-        # the index returns the fids of all features whose bounding
-        # box intersects with the supplied point
-        fids = [int(i) for i in regions_ix.intersection(pt_geom.bounds)]
-
-        # now that option have been narrowed down determine if the
-        # point really intersects the supplied candidates
-        for fid in fids:
-            row = reg[fid]
-            reg_geom = shape(row['geometry'])
-            if reg_geom.intersects(pt_geom):
-                props = row['properties']
-                name = props[name_field]
-
-                return name
+    # each region layer is read once and all of the desert stops are
+    # reprojected to wgs84 and tagged with their regions in bulk
+    xs = [props['x'] for props in csv_rows]
+    ys = [props['y'] for props in csv_rows]
+    lons, lats = transform_coordinates(xs, ys, 2913, 4326)
+
+    city = find_intersecting_regions(
+        xs, ys, load_region_layer(cities, 'CITYNAME'))
+    county = find_intersecting_regions(
+        xs, ys, load_region_layer(counties, 'COUNTY'))
+    hood = find_intersecting_regions(
+        xs, ys, load_region_layer(nbo_hoods, 'NAME'))
+    t6_status = find_intersecting_regions(
+        xs, ys, load_region_layer(t6_block_groups, 'min_pov'))
+
+    for i, props in enumerate(csv_rows):
+        props['lat'] = float(lats[i])
+        props['lon'] = float(lons[i])
+        props['hood'] = hood[i]
+        props['t6_status'] = t6_status[i]
+
+        # stops outside of every city are labeled with their county
+        if city[i]:
+            props['city/county'] = city[i]
+        elif county[i]:
+            props['city/county'] = '{} County'.format(county[i])
+        else:
+            props['city/county'] = None
+
+    return [OrderedDict((k, props[k]) for k in csv_fields)
+            for props in csv_rows]
+
+
+def get_transformer(src_srs, dst_srs):
+    """Return the cached pyproj transformer between the two supplied epsg
+    codes, building it on first request.  pyproj assumes coordinates are
+    meters, but ospn is in feet, thus the 'preserve_units' parameter, see:
+    http://gis.stackexchange.com/questions/10209"""
+
+    key = (int(src_srs), int(dst_srs))
+    if key not in transformers:
+        transformers[key] = pyproj.Transformer.from_proj(
+            pyproj.Proj(init='epsg:{}'.format(key[0]), preserve_units=True),
+            pyproj.Proj(init='epsg:{}'.format(key[1]), preserve_units=True))
+
+    return transformers[key]
+
+
+def transform_coordinates(xs, ys, src_srs, dst_srs):
+    """Reproject sequences of x and y coordinates from the source to the
+    destination epsg in one call, numpy arrays of the transformed x and y
+    values are returned"""
+
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    if not xs.size:
+        return xs, ys
+
+    transformer = get_transformer(src_srs, dst_srs)
+    return transformer.transform(xs, ys)
 
 
 def export_loc_info_to_csv():
@@ -3,15 +3,17 @@ import csv
 import requests
 import sys
 from collections import defaultdict, OrderedDict
-from functools import partial
 from os.path import abspath, dirname, join
 
 import fiona
+import numpy
 import pyproj
 from openpyxl import load_workbook
 from rtree import index
-from shapely import ops
-from shapely.geometry import mapping, shape, Point
+from scipy.spatial import cKDTree
+from shapely.geometry import shape, Point
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
 
 HOME = dirname(dirname(abspath(__file__)))
 EMP_FILE_NAME = 'TriMet Employer List 2015 - Oct 15.xlsx'
@@ -21,15 +23,31 @@ GEOCODED = join(HOME, 'xlsx', GEO_FILE_NAME)
 UNGEOCODEABLE = join(HOME, 'csv', 'ungeocodeable_addresses.csv')
 RAIL_STOP = '//gisstore/gis/TRIMET/rail_stop.shp'
 EMP_STATIONS = join(HOME, 'csv', 'employers_half_mile_max_orange_v2.csv')
+EMP_STATIONS_TEMPLATE = join(
+    HOME, 'csv', 'employers_{radius}ft_max_{line}.csv')
+EMP_STATION_MATRIX = join(HOME, 'csv', 'employer_station_matrix.csv')
+
+# rail stop 'LINE' values and radii (in feet) used by the station matrix
+MATRIX_LINES = ['B', 'G', 'O', 'R', 'Y']
+MATRIX_RADII = [5280 / 4, 5280 / 2, 5280]
+
+# pyproj transformers are expensive to build so they are created once per
+# (source, destination) epsg pair and reused for the rest of the run
+TRANSFORMERS = dict()
 
 
 def get_ospn_coordinates_for_employers():
     """"""
 
     rlis_token = process_options().rlis_token
-    wgs2ospn = create_transformation('4326', '2913')
     ungeocodeable = list()
 
+    # rows with lat/lon values are held here so that they can all be
+    # reprojected to state plane in a single call once the loop is done
+    wgs_rows = list()
+    wgs_lons = list()
+    wgs_lats = list()
+
     wb = load_workbook(EMPLOYERS)
     ws = wb.worksheets[0]
 
@@ -54,7 +72,6 @@ def get_ospn_coordinates_for_employers():
 
         if lat:
             lat, lon = float(lat), float(lon)
-            x, y = convert_coordinates(lon, lat, wgs2ospn)
         else:
             # within the spreadsheet some zip values are stored as
             # float which leaves a trailing zero
@@ -70,18 +87,25 @@ def get_ospn_coordinates_for_employers():
 
             rlis_gc = rlis_geocode(addr_str, rlis_token)
             if rlis_gc:
-                x, y = rlis_gc['ORSP_x'], rlis_gc['ORSP_y']
+                row[x_ix].value = rlis_gc['ORSP_x']
+                row[y_ix].value = rlis_gc['ORSP_y']
+                continue
+
+            google_gc = google_geocode(addr_str)
+            if google_gc:
+                lon, lat = google_gc['lng'], google_gc['lat']
             else:
-                google_gc = google_geocode(addr_str)
-                if google_gc:
-                    lon, lat = google_gc['lng'], google_gc['lat']
-                    x, y = convert_coordinates(lon, lat, wgs2ospn)
-                else:
-                    ungeocodeable.append([cell.value for cell in row])
-                    continue
+                ungeocodeable.append([cell.value for cell in row])
+                continue
 
-        row[x_ix].value = x
-        row[y_ix].value = y
+        wgs_rows.append(row)
+        wgs_lons.append(lon)
+        wgs_lats.append(lat)
+
+    xs, ys = transform_coordinates(wgs_lons, wgs_lats, 4326, 2913)
+    for row, x, y in zip(wgs_rows, xs, ys):
+        row[x_ix].value = float(x)
+        row[y_ix].value = float(y)
 
     wb.save(GEOCODED)
 
@@ -109,24 +133,33 @@ def process_options():
     return options
 
 
-def create_transformation(src_srs, dst_srs):
-    """"""
+def get_transformer(src_srs, dst_srs):
+    """Return the cached pyproj transformer between the two supplied epsg
+    codes, building it on first request.  pyproj assumes coordinates are
+    meters, but ospn is in feet, thus the 'preserve_units' parameter, see:
+    http://gis.stackexchange.com/questions/10209"""
 
-    transformation = partial(
-            pyproj.transform,
-            pyproj.Proj(init='epsg:{}'.format(src_srs)),
-            pyproj.Proj(init='epsg:{}'.format(dst_srs), preserve_units=True))
+    key = (int(src_srs), int(dst_srs))
+    if key not in TRANSFORMERS:
+        TRANSFORMERS[key] = pyproj.Transformer.from_proj(
+            pyproj.Proj(init='epsg:{}'.format(key[0]), preserve_units=True),
+            pyproj.Proj(init='epsg:{}'.format(key[1]), preserve_units=True))
 
-    return transformation
+    return TRANSFORMERS[key]
 
 
-def convert_coordinates(x, y, transformation):
-    """"""
+def transform_coordinates(xs, ys, src_srs, dst_srs):
+    """Reproject sequences of x and y coordinates from the source to the
+    destination epsg in one call, numpy arrays of the transformed x and y
+    values are returned"""
 
-    src_pt = Point(x, y)
-    dst_pt = ops.transform(transformation, src_pt)
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    if not xs.size:
+        return xs, ys
 
-    return dst_pt.x, dst_pt.y
+    transformer = get_transformer(src_srs, dst_srs)
+    return transformer.transform(xs, ys)
 
 
 def rlis_geocode(addr_str, token):
@@ -183,23 +216,107 @@ def google_geocode(addr_str):
         return None
 
 
-def get_employers_near_stops():
-    """"""
+def get_employers_near_stops(buffer_join=False):
+    """Write the employers that are within a set distance of the filtered
+    rail stops to csv along with the names of those stops.  By default
+    stops are matched with a kd-tree radius query on the stop points which
+    is exact and also reports distances, if 'buffer_join' is True the
+    original buffer polygon intersection join is used instead"""
 
     distance = 5280 / 2
     filter_field = 'LINE'
     filter_vals = ['O']
 
-    stop_buffers = dict()
+    stops = dict()
     stop_names = dict()
     with fiona.open(RAIL_STOP) as rail_stop:
         for fid, feat in rail_stop.items():
             fields = feat['properties']
             if fields[filter_field] in filter_vals:
                 geom = shape(feat['geometry'])
-                feat['geometry'] = mapping(geom.buffer(distance))
-                stop_buffers[fid] = feat
+                if buffer_join:
+                    geom = geom.buffer(distance)
+
+                feat['geometry'] = geom
+                stops[fid] = feat
+                stop_names[fid] = fields['STATION']
+
+    header, rows, employers = get_geocoded_employers()
+
+    if buffer_join:
+        join_mapping = spatial_join(stops, employers)
+        join_distances = None
+    else:
+        join_mapping, join_distances = distance_join(
+            stops, employers, distance)
+
+    write_employer_stations(EMP_STATIONS, header, rows, stop_names,
+                            join_mapping, join_distances)
+
+
+def get_employer_station_matrix(lines=MATRIX_LINES, radii=MATRIX_RADII):
+    """Find the stations within each of the supplied radii (in feet) of
+    every employer for each of the supplied values of the rail stop 'LINE'
+    field.  The workbook is read and the stop kd-tree is built a single
+    time and all stop/employer pairs within the largest radius are found
+    in one query, those pairs are then binned by line and radius.  A
+    matrix with a station count for each employer and (line, radius)
+    combination is written along with a csv per combination in the format
+    of get_employers_near_stops"""
+
+    radii = sorted(radii)
+    combos = [(ln, r) for ln in lines for r in radii]
+
+    stops = dict()
+    stop_names = dict()
+    stop_lines = dict()
+    with fiona.open(RAIL_STOP) as rail_stop:
+        for fid, feat in rail_stop.items():
+            fields = feat['properties']
+            if fields['LINE'] in lines:
+                feat['geometry'] = shape(feat['geometry'])
+                stops[fid] = feat
                 stop_names[fid] = fields['STATION']
+                stop_lines[fid] = fields['LINE']
+
+    header, rows, employers = get_geocoded_employers()
+    join_mapping, join_distances = distance_join(
+        stops, employers, radii[-1])
+
+    combo_mappings = {c: defaultdict(list) for c in combos}
+    combo_distances = {c: defaultdict(list) for c in combos}
+    for e_fid, stop_ids in join_mapping.items():
+        for s_fid, dist in zip(stop_ids, join_distances[e_fid]):
+            line = stop_lines[s_fid]
+            for r in radii:
+                if dist <= r:
+                    combo_mappings[(line, r)][e_fid].append(s_fid)
+                    combo_distances[(line, r)][e_fid].append(dist)
+
+    with open(EMP_STATION_MATRIX, 'wb') as matrix_csv:
+        matrix_writer = csv.writer(matrix_csv)
+        matrix_header = ['Row'] + ['{}_{}'.format(ln, r) for ln, r in combos]
+        matrix_writer.writerow(matrix_header)
+
+        for e_fid in sorted(join_mapping):
+            # the row number is the one displayed in excel, the header
+            # occupies row 1 and rows are indexed from zero here
+            matrix_row = [e_fid + 2]
+            for c in combos:
+                matrix_row.append(len(combo_mappings[c].get(e_fid, [])))
+            matrix_writer.writerow(matrix_row)
+
+    for line, r in combos:
+        combo_path = EMP_STATIONS_TEMPLATE.format(line=line, radius=r)
+        write_employer_stations(
+            combo_path, header, rows, stop_names,
+            combo_mappings[(line, r)], combo_distances[(line, r)])
+
+
+def get_geocoded_employers():
+    """Read the geocoded employer workbook returning its header, the cell
+    values of each of its rows and a dictionary of point features for the
+    employers that have coordinates keyed on their row index"""
 
     wb = load_workbook(GEOCODED)
     ws = wb.worksheets[0]
@@ -208,31 +325,47 @@ def get_employers_near_stops():
     x_ix = header.index('X Coordinate')
     y_ix = header.index('Y Coordinate')
 
+    rows = list()
     employers = dict()
     for i, row in enumerate(ws.iter_rows(row_offset=1)):
-        x, y = row[x_ix].value, row[y_ix].value
+        field_vals = [cell.value for cell in row]
+        rows.append(field_vals)
+
+        x, y = field_vals[x_ix], field_vals[y_ix]
         if x and y:
             feat = dict()
             x, y = float(x), float(y)
-            feat['geometry'] = mapping(Point(x, y))
-            field_vals = [cell.value for cell in row]
+            feat['geometry'] = Point(x, y)
             feat['properties'] = OrderedDict(zip(header, field_vals))
             employers[i] = feat
 
-    join_mapping = spatial_join(stop_buffers, employers)
+    return header, rows, employers
+
+
+def write_employer_stations(csv_path, header, rows, stop_names,
+                            join_mapping, join_distances=None):
+    """Write the employer rows that were matched to at least one station
+    to csv, preceded by the matched station names and, if supplied, the
+    distances to those stations"""
+
+    station_header = ['Stations'] + header
+    if join_distances is not None:
+        station_header.insert(1, 'Station Distances')
 
-    with open(EMP_STATIONS, 'wb') as emp_stations:
+    with open(csv_path, 'wb') as emp_stations:
         emp_writer = csv.writer(emp_stations)
-        station_header = ['Stations'] + header
         emp_writer.writerow(station_header)
 
-        for i, row in enumerate(ws.iter_rows(row_offset=1)):
+        for i, field_vals in enumerate(rows):
             if i in join_mapping:
                 station_ids = join_mapping[i]
                 station_str = ', '.join([stop_names[sid] for sid in station_ids])
                 csv_row = [station_str]
-                for cell in row:
-                    value = cell.value
+                if join_distances is not None:
+                    csv_row.append(', '.join(
+                        ['{:.1f}'.format(d) for d in join_distances[i]]))
+
+                for value in field_vals:
                     if isinstance(value, unicode):
                         value = value.encode('utf-8')
                     csv_row.append(value)
@@ -240,33 +373,113 @@ def get_employers_near_stops():
                 emp_writer.writerow(csv_row)
 
 
-def spatial_join(target_feats, join_feats):
+def build_join_targets(target_feats):
+    """Parse each target geometry a single time, prepare it for repeated
+    predicate tests and bulk load the bounds into an rtree index, the
+    result can be handed to spatial_join any number of times"""
+
+    t_fids = list()
+    t_prepared = list()
+    index_items = list()
+
+    for i, (t_fid, t_feat) in enumerate(target_feats.items()):
+        t_geom = t_feat['geometry']
+        if not isinstance(t_geom, BaseGeometry):
+            t_geom = shape(t_geom)
+
+        t_fids.append(t_fid)
+        t_prepared.append(prep(t_geom))
+        index_items.append((i, t_geom.bounds, None))
+
+    # stream loading is much faster than inserting one item at a time,
+    # but rtree raises an error if the stream is empty
+    if index_items:
+        s_index = index.Index(index_items)
+    else:
+        s_index = index.Index()
+
+    return t_fids, t_prepared, s_index
+
+
+def spatial_join(target_feats, join_feats, join_targets=None):
     """this function expects features to be inputting in the format
     generated by fiona, a dictionary with fid as key and a json oject
-    as the value with the geometry and attributes"""
-
-    s_index = index.Index()
-    join_mapping = defaultdict(list)
+    as the value with the geometry and attributes, geometries may also
+    already be shapely objects.  a mapping of join fid to the list of
+    target fids that it intersects is returned"""
 
-    for t_fid, t_feat in target_feats.items():
-        t_geom = shape(t_feat['geometry'])
-        s_index.insert(t_fid, t_geom.bounds)
+    if join_targets is None:
+        join_targets = build_join_targets(target_feats)
+    t_fids, t_prepared, s_index = join_targets
 
+    join_mapping = defaultdict(list)
     for j_fid, j_feat in join_feats.items():
-        j_geom = shape(j_feat['geometry'])
+        j_geom = j_feat['geometry']
+        if not isinstance(j_geom, BaseGeometry):
+            j_geom = shape(j_geom)
 
-        for t_fid in s_index.intersection(j_geom.bounds):
-            t_geom = shape(target_feats[t_fid]['geometry'])
-            if j_geom.intersects(t_geom):
-                join_mapping[j_fid].append(t_fid)
+        for i in s_index.intersection(j_geom.bounds):
+            if t_prepared[i].intersects(j_geom):
+                join_mapping[j_fid].append(t_fids[i])
 
     return join_mapping
 
 
+def get_point_coordinates(feats):
+    """Return the fids of the supplied point features along with an n x 2
+    numpy array of their coordinates"""
+
+    fids = list()
+    coords = list()
+    for fid, feat in feats.items():
+        geom = feat['geometry']
+        if not isinstance(geom, BaseGeometry):
+            geom = shape(geom)
+
+        fids.append(fid)
+        coords.append((geom.x, geom.y))
+
+    return fids, numpy.array(coords, dtype=float).reshape(-1, 2)
+
+
+def distance_join(target_feats, join_feats, distance):
+    """Match each join point to all of the target points that are within
+    'distance' of it.  Both sets of points are put in kd-trees and every
+    pair within range is found in a single query, so no buffers are built
+    and the distances are exact.  Two mappings keyed on join fid are
+    returned, one with the matched target fids (nearest first) and one
+    with the corresponding distances"""
+
+    join_mapping = defaultdict(list)
+    join_distances = defaultdict(list)
+
+    t_fids, t_coords = get_point_coordinates(target_feats)
+    j_fids, j_coords = get_point_coordinates(join_feats)
+    if not len(t_fids) or not len(j_fids):
+        return join_mapping, join_distances
+
+    t_tree = cKDTree(t_coords)
+    j_tree = cKDTree(j_coords)
+
+    # the 'ndarray' output type is used because the sparse matrix types
+    # drop pairs whose distance is zero
+    pairs = j_tree.sparse_distance_matrix(
+        t_tree, distance, output_type='ndarray')
+    pairs.sort(order=['i', 'v'])
+
+    for j_ix, t_ix, dist in zip(pairs['i'], pairs['j'], pairs['v']):
+        j_fid = j_fids[j_ix]
+        join_mapping[j_fid].append(t_fids[t_ix])
+        join_distances[j_fid].append(float(dist))
+
+    return join_mapping, join_distances
+
+
 def main():
     """"""
 
     # get_ospn_coordinates_for_employers()
+    # get_employer_station_matrix()
     get_employers_near_stops()
 
 
@@ -5,18 +5,19 @@ import requests
 import subprocess
 from pprint import pprint
 from os.path import basename, join
-from functools import partial
 from collections import OrderedDict
 
+import numpy
 import pyproj
-from shapely import ops
-from shapely.geometry import Point
 
 MIN_LON = -122.6640272
 MIN_LAT = 45.5059634
 MAX_LON = -122.6627076
 MAX_LAT = 45.5080312
 
+# pyproj transformers are cached by (source, destination) epsg pair
+TRANSFORMERS = dict()
+
 
 def get_images_from_service(token):
     """"""
@@ -77,26 +78,47 @@ def get_images_from_service(token):
 def get_ospn_coords_from_latlon():
     """"""
 
-    lower_left = Point(MIN_LON, MIN_LAT)
-    upper_right = Point(MAX_LON, MAX_LAT)
-
-    latlon2ospn = partial(
-            pyproj.transform,
-            pyproj.Proj(init='epsg:4326'),
-            pyproj.Proj(init='epsg:2913', preserve_units=True)
-        )
-
-    ospn_ll = ops.transform(latlon2ospn, lower_left)
-    ospn_ur = ops.transform(latlon2ospn, upper_right)
+    # lower left and upper right corners are reprojected together
+    xs, ys = transform_coordinates(
+        [MIN_LON, MAX_LON], [MIN_LAT, MAX_LAT], 4326, 2913)
 
     return OrderedDict([
-        ('min_x', ospn_ll.x),
-        ('min_y', ospn_ll.y),
-        ('max_x', ospn_ur.x),
-        ('max_y', ospn_ur.y)
+        ('min_x', float(xs[0])),
+        ('min_y', float(ys[0])),
+        ('max_x', float(xs[1])),
+        ('max_y', float(ys[1]))
     ])
 
 
+def get_transformer(src_srs, dst_srs):
+    """Return the cached pyproj transformer between the two supplied epsg
+    codes, building it on first request.  pyproj assumes coordinates are
+    meters, but ospn is in feet, thus the 'preserve_units' parameter, see:
+    http://gis.stackexchange.com/questions/10209"""
+
+    key = (int(src_srs), int(dst_srs))
+    if key not in TRANSFORMERS:
+        TRANSFORMERS[key] = pyproj.Transformer.from_proj(
+            pyproj.Proj(init='epsg:{}'.format(key[0]), preserve_units=True),
+            pyproj.Proj(init='epsg:{}'.format(key[1]), preserve_units=True))
+
+    return TRANSFORMERS[key]
+
+
+def transform_coordinates(xs, ys, src_srs, dst_srs):
+    """Reproject sequences of x and y coordinates from the source to the
+    destination epsg in one call, numpy arrays of the transformed x and y
+    values are returned"""
+
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    if not xs.size:
+        return xs, ys
+
+    transformer = get_transformer(src_srs, dst_srs)
+    return transformer.transform(xs, ys)
+
+
 def process_options(arg_list=None):
     """"""
 
@@ -0,0 +1,340 @@
+import csv
+import sys
+from argparse import ArgumentParser
+from collections import OrderedDict
+from os.path import splitext
+
+import fiona
+import numpy
+import pyproj
+from rtree import index
+from shapely import vectorized
+from shapely.geometry import shape, Point
+from shapely.prepared import prep
+
+# oregon state plane north (feet), the projection of rlis and most of the
+# point layers that get attributed with this tool
+SRC_SRID = 2913
+WGS84_SRID = 4326
+
+# number of points that are read, attributed and written at a time, the
+# polygon layers are only read once regardless of the batch size
+BATCH_SIZE = 10000
+
+# pyproj transformers are cached by (source, destination) epsg pair
+TRANSFORMERS = dict()
+
+
+def attribute_points(points_path, output_path, attributes, fallbacks=None,
+                     keep_fields=None, src_srs=SRC_SRID, layer=None):
+    """Tag every point in the source layer with the name of the polygon it
+    falls within from each of the attribute layers, add wgs84 lat/lon and
+    stream the results to a csv or geopackage (chosen by the extension of
+    the output path).
+
+    'attributes' is a list of (polygon path, name field, output column)
+    triples and 'fallbacks' a list of (output column, sources) pairs where
+    sources is a list of (column, template) pairs, the output column gets
+    the first source value that isn't null or empty formatted with its
+    template.  For example:
+    [('city/county', [('city', '{}'), ('county', '{} County')])]
+    gives the city name if the point is in one, otherwise the county.
+    The polygon layers must be in the same projection as the points"""
+
+    region_layers = OrderedDict()
+    for regions, name_field, column in attributes:
+        region_layers[column] = load_region_layer(regions, name_field)
+
+    fallbacks = fallbacks or list()
+    point_count = 0
+    with fiona.open(points_path, layer=layer) as points:
+        fields = [f for f in points.schema['properties']
+                  if keep_fields is None or f in keep_fields]
+        writer = open_writer(output_path, points, fields,
+                             attributes, fallbacks)
+
+        try:
+            batch = list()
+            for feat in points:
+                batch.append(feat)
+                if len(batch) >= BATCH_SIZE:
+                    writer.write(attribute_batch(
+                        batch, fields, region_layers, fallbacks, src_srs))
+                    point_count += len(batch)
+                    batch = list()
+
+            writer.write(attribute_batch(
+                batch, fields, region_layers, fallbacks, src_srs))
+            point_count += len(batch)
+        finally:
+            writer.close()
+
+    return point_count
+
+
+def attribute_batch(features, fields, region_layers, fallbacks, src_srs):
+    """Attribute a list of point features, the regions of every layer and
+    the wgs84 coordinates are found for the whole batch at once, a list
+    of (geometry, properties) pairs is returned"""
+
+    if not features:
+        return list()
+
+    xs = numpy.array([f['geometry']['coordinates'][0] for f in features])
+    ys = numpy.array([f['geometry']['coordinates'][1] for f in features])
+    lons, lats = transform_coordinates(xs, ys, src_srs, WGS84_SRID)
+
+    region_names = OrderedDict()
+    for column, region_layer in region_layers.items():
+        region_names[column] = find_intersecting_regions(
+            xs, ys, region_layer)
+
+    records = list()
+    for i, feat in enumerate(features):
+        props = OrderedDict((f, feat['properties'][f]) for f in fields)
+        props['lat'] = float(lats[i])
+        props['lon'] = float(lons[i])
+        for column, names in region_names.items():
+            props[column] = names[i]
+
+        for column, sources in fallbacks:
+            props[column] = None
+            for source, template in sources:
+                if props[source]:
+                    props[column] = template.format(props[source])
+                    break
+
+        records.append((feat['geometry'], props))
+
+    return records
+
+
+def load_region_layer(regions, name_field):
+    """Read a polygon layer a single time, returning its geometries, the
+    value of the name field for each, prepared versions of the geometries
+    and an rtree index of their bounds"""
+
+    geoms = list()
+    names = list()
+    spatial_ix = index.Index()
+    with fiona.open(regions) as reg:
+        for f in reg:
+            geom = shape(f['geometry'])
+            spatial_ix.insert(len(geoms), geom.bounds)
+            geoms.append(geom)
+            names.append(f['properties'][name_field])
+
+    prepared = [prep(g) for g in geoms]
+    return geoms, names, prepared, spatial_ix
+
+
+def find_intersecting_regions(xs, ys, region_layer):
+    """Return an array holding the name of the region that each of the
+    supplied points falls within (None if it isn't in any, the first
+    region wins where they overlap).  The points are sorted on x so those
+    in each region's bounding box can be found with a binary search and
+    then tested in one vectorized call, points on a region boundary aren't
+    contained by it so any left unmatched get an exact intersects test
+    against their index candidates"""
+
+    geoms, names, prepared, spatial_ix = region_layer
+    x_order = numpy.argsort(xs)
+    sorted_xs = xs[x_order]
+    region_ix = numpy.full(len(xs), -1, dtype=int)
+
+    for i, geom in enumerate(geoms):
+        min_x, min_y, max_x, max_y = geom.bounds
+        lo = numpy.searchsorted(sorted_xs, min_x, side='left')
+        hi = numpy.searchsorted(sorted_xs, max_x, side='right')
+        candidates = x_order[lo:hi]
+        candidates = candidates[
+            (ys[candidates] >= min_y) & (ys[candidates] <= max_y) &
+            (region_ix[candidates] == -1)]
+        if not candidates.size:
+            continue
+
+        inside = vectorized.contains(geom, xs[candidates], ys[candidates])
+        region_ix[candidates[inside]] = i
+
+    for pt_ix in numpy.flatnonzero(region_ix == -1):
+        pt_geom = Point(xs[pt_ix], ys[pt_ix])
+        for i in sorted(spatial_ix.intersection(pt_geom.bounds)):
+            if prepared[i].intersects(pt_geom):
+                region_ix[pt_ix] = i
+                break
+
+    region_names = numpy.array(names + [None], dtype=object)
+    return region_names[region_ix]
+
+
+def get_transformer(src_srs, dst_srs):
+    """Return the cached pyproj transformer between the two supplied epsg
+    codes, building it on first request.  pyproj assumes coordinates are
+    meters, but ospn is in feet, thus the 'preserve_units' parameter, see:
+    http://gis.stackexchange.com/questions/10209"""
+
+    key = (int(src_srs), int(dst_srs))
+    if key not in TRANSFORMERS:
+        TRANSFORMERS[key] = pyproj.Transformer.from_proj(
+            pyproj.Proj(init='epsg:{}'.format(key[0]), preserve_units=True),
+            pyproj.Proj(init='epsg:{}'.format(key[1]), preserve_units=True))
+
+    return TRANSFORMERS[key]
+
+
+def transform_coordinates(xs, ys, src_srs, dst_srs):
+    """Reproject sequences of x and y coordinates from the source to the
+    destination epsg in one call, numpy arrays of the transformed x and y
+    values are returned"""
+
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    if not xs.size:
+        return xs, ys
+
+    transformer = get_transformer(src_srs, dst_srs)
+    return transformer.transform(xs, ys)
+
+
+def open_writer(output_path, points, fields, attributes, fallbacks):
+    """Return a writer for the output path, a geopackage if the path ends
+    in .gpkg and a csv otherwise"""
+
+    columns = fields + ['lat', 'lon'] + [a[2] for a in attributes] + \
+        [f[0] for f in fallbacks]
+
+    if splitext(output_path)[1].lower() == '.gpkg':
+        src_props = points.schema['properties']
+        props = OrderedDict((f, src_props[f]) for f in fields)
+        props['lat'] = 'float'
+        props['lon'] = 'float'
+        for regions, name_field, column in attributes:
+            with fiona.open(regions) as reg:
+                props[column] = reg.schema['properties'][name_field]
+        for column, sources in fallbacks:
+            props[column] = 'str'
+
+        schema = dict(geometry='Point', properties=props)
+        return GeoPackageWriter(output_path, schema, points.crs)
+
+    return CsvWriter(output_path, columns)
+
+
+class CsvWriter(object):
+    """"""
+
+    def __init__(self, csv_path, columns):
+        self.csv_file = open(csv_path, 'wb')
+        self.writer = csv.writer(self.csv_file)
+        self.writer.writerow(columns)
+
+    def write(self, records):
+        for geom, props in records:
+            # the python 2 csv module can't write non-ascii unicode
+            self.writer.writerow(
+                [v.encode('utf-8') if isinstance(v, unicode) else v
+                 for v in props.values()])
+
+    def close(self):
+        self.csv_file.close()
+
+
+class GeoPackageWriter(object):
+    """"""
+
+    def __init__(self, gpkg_path, schema, crs):
+        self.collection = fiona.open(
+            gpkg_path, 'w', driver='GPKG', schema=schema, crs=crs)
+
+    def write(self, records):
+        self.collection.writerecords(
+            [dict(geometry=geom, properties=props)
+             for geom, props in records])
+
+    def close(self):
+        self.collection.close()
+
+
+def parse_fallback(fallback):
+    """Convert a fallback from the command line, an output column followed
+    by source columns that may have a format template attached with a
+    colon (e.g. 'county:{} County'), into an (output column, sources)
+    pair"""
+
+    sources = list()
+    for source in fallback[1:]:
+        column, _, template = source.partition(':')
+        sources.append((column, template or '{}'))
+
+    return fallback[0], sources
+
+
+def process_options(args=None):
+    """"""
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        'points',
+        help='point layer to be attributed, any format fiona can read'
+    )
+    parser.add_argument(
+        'output',
+        help='destination of the attributed points, written as a '
+             'geopackage if the path ends in .gpkg, otherwise a csv'
+    )
+    parser.add_argument(
+        '-a', '--attribute',
+        nargs=3,
+        action='append',
+        required=True,
+        dest='attributes',
+        metavar=('PATH', 'NAME_FIELD', 'COLUMN'),
+        help='polygon layer whose name field is added to the points as '
+             'the given column, may be supplied more than once'
+    )
+    parser.add_argument(
+        '-f', '--fallback',
+        nargs='+',
+        action='append',
+        dest='fallbacks',
+        metavar='COLUMN',
+        help='output column followed by the attribute columns it is '
+             'filled from in order of preference, a source can carry a '
+             'format template after a colon, for example: '
+             '-f city/county city "county:{} County"'
+    )
+    parser.add_argument(
+        '-k', '--keep',
+        nargs='+',
+        dest='keep_fields',
+        help='fields of the point layer that are carried to the output, '
+             'all are kept by default'
+    )
+    parser.add_argument(
+        '-s', '--srs',
+        type=int,
+        default=SRC_SRID,
+        help='epsg code of the points and polygon layers'
+    )
+    parser.add_argument(
+        '-l', '--layer',
+        help='layer of the point source to read if it has several'
+    )
+
+    options = parser.parse_args(args)
+    return options
+
+
+def main():
+    """"""
+
+    args = sys.argv[1:]
+    opts = process_options(args)
+
+    fallbacks = [parse_fallback(f) for f in opts.fallbacks or list()]
+    attribute_points(opts.points, opts.output, opts.attributes, fallbacks,
+                     opts.keep_fields, opts.srs, opts.layer)
+
+
+if __name__ == '__main__':
+    main()
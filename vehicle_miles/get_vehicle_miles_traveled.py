@@ -1,8 +1,11 @@
 import fiona, cx_Oracle
+import os
 from os import path
 from fiona import crs
 from datetime import datetime
-from shapely.geometry import shape, mapping
+from shapely import wkb
+from shapely.geometry import box, shape, mapping
+from shapely.prepared import prep
 
 pwd_msg = 'enter pwd for db: {0}, user: {1}\n'
 dat_msg = 'enter begin date of service period as m/d/yy:\n'
@@ -23,6 +26,16 @@ vm_routes_name = name_template.format(serv_date.strftime('%Y-%m-%d'))
 vm_routes_path = path.join(project_dir, 'shp', vm_routes_name)
 cities_path = path.join(rlis_dir, 'BOUNDARY', 'cty_fill.shp')
 
+# city geometries are cached as wkb so that later runs don't have to scan
+# the cities shapefile, a cache is rebuilt if the shapefile is newer
+city_cache_dir = path.join(project_dir, 'cache')
+city_cache = {}
+
+# the city's extent is split into a grid with this many tiles per side
+# and segments whose extent only covers tiles entirely inside (or outside)
+# of the city are classified without testing them against the polygon
+city_tile_grid = 16
+
 def getHastusShapefilePath():
 	"""The appropriate shapefile is in folder that is based the service
 	date of interest, so the user entered date is used to grab the 
@@ -92,7 +105,7 @@ def clipAddTripVolumeToRoutes():
 
 	hastus_path = getHastusShapefilePath()
 	volume_dict = getPatternVolumesFromOracle()
-	city_geom = getCityLimitsGeom('Beaverton')
+	city_clipper = getCityClipper(getCityLimitsGeom('Beaverton'))
 
 	# note that fiona doesn't have the ability modify existing shapefiles
 	# thus the creation of a new one here
@@ -111,18 +124,15 @@ def clipAddTripVolumeToRoutes():
 		unmatched_patterns = set()
 		with fiona.open(vm_routes_path, 'w', **metadata) as vm_routes:
 			for hr in hastus_routes:
-				add_flag = False
 				geom = shape(hr['geometry'])
 				
 				# include segments only if they are in the city of interest
 				# and if they straddle the city limits then clip them
-				if geom.within(city_geom):
-					add_flag = True
-				elif geom.intersects(city_geom):
-					hr['geometry'] = mapping(geom.intersection(city_geom))
-					add_flag = True
+				clip_geom = clipToCity(geom, city_clipper)
+				if clip_geom is not geom and clip_geom is not None:
+					hr['geometry'] = mapping(clip_geom)
 
-				if add_flag:
+				if clip_geom is not None:
 					# get the pattern volume from the volume dict
 					props = hr['properties']
 					date = props['EFFDATE']
@@ -140,7 +150,7 @@ def clipAddTripVolumeToRoutes():
 						props['trip_mode'] = None
 					
 					# update length field
-					props['LENGTH'] = geom.length
+					props['LENGTH'] = clip_geom.length
 					
 					vm_routes.write(hr)
 
@@ -151,15 +161,98 @@ def clipAddTripVolumeToRoutes():
 
 def getCityLimitsGeom(name):
 	"""Extract thet geometry of the city of interest and assign it to a 
-	variable"""
+	variable, the geometry is cached in memory and on disk"""
+
+	if name in city_cache:
+		return city_cache[name]
+
+	cache_path = path.join(city_cache_dir, 'city_{0}.wkb'.format(name))
+	if path.exists(cache_path) and \
+			path.getmtime(cache_path) >= path.getmtime(cities_path):
+		with open(cache_path, 'rb') as cache_file:
+			city_cache[name] = wkb.loads(cache_file.read())
+		return city_cache[name]
 
 	with fiona.open(cities_path) as cities:
 		for c in cities:
 			if c['properties']['CITYNAME'] == name:
 				city_geom = shape(c['geometry'])
 
+	if not path.exists(city_cache_dir):
+		os.makedirs(city_cache_dir)
+	with open(cache_path, 'wb') as cache_file:
+		cache_file.write(city_geom.wkb)
+
+	city_cache[name] = city_geom
 	return city_geom
 
+def getCityClipper(city_geom):
+	"""Prepare the city polygon for repeated clipping and classify each
+	tile of a grid over its extent as inside (1), outside (0) or on the
+	boundary (-1) of the city"""
+
+	prepared = prep(city_geom)
+	min_x, min_y, max_x, max_y = city_geom.bounds
+	tile_w = (max_x - min_x) / city_tile_grid
+	tile_h = (max_y - min_y) / city_tile_grid
+
+	tiles = {}
+	for i in range(city_tile_grid):
+		for j in range(city_tile_grid):
+			tile = box(min_x + i * tile_w, min_y + j * tile_h,
+				min_x + (i + 1) * tile_w, min_y + (j + 1) * tile_h)
+
+			if prepared.contains(tile):
+				tiles[(i, j)] = 1
+			elif prepared.intersects(tile):
+				tiles[(i, j)] = -1
+			else:
+				tiles[(i, j)] = 0
+
+	return {
+		'geom': city_geom,
+		'prepared': prepared,
+		'bounds': city_geom.bounds,
+		'tile_size': (tile_w, tile_h),
+		'tiles': tiles}
+
+def clipToCity(geom, city_clipper):
+	"""Return the geometry itself if it's within the city, its
+	intersection with the city if it straddles the city limits and None
+	if it's outside of them.  The exact intersection is only computed for
+	geometries that cross the boundary"""
+
+	c_min_x, c_min_y, c_max_x, c_max_y = city_clipper['bounds']
+	min_x, min_y, max_x, max_y = geom.bounds
+	if min_x > c_max_x or max_x < c_min_x or \
+			min_y > c_max_y or max_y < c_min_y:
+		return None
+
+	# the tiles only cover the city's extent, geometries reaching beyond
+	# it go straight to the prepared polygon
+	if min_x >= c_min_x and max_x <= c_max_x and \
+			min_y >= c_min_y and max_y <= c_max_y:
+		tile_w, tile_h = city_clipper['tile_size']
+		last = city_tile_grid - 1
+		cols = range(min(int((min_x - c_min_x) / tile_w), last),
+			min(int((max_x - c_min_x) / tile_w), last) + 1)
+		rows = range(min(int((min_y - c_min_y) / tile_h), last),
+			min(int((max_y - c_min_y) / tile_h), last) + 1)
+		status = set(city_clipper['tiles'][(i, j)]
+			for i in cols for j in rows)
+
+		if status == set([1]):
+			return geom
+		elif status == set([0]):
+			return None
+
+	if city_clipper['prepared'].contains(geom):
+		return geom
+	elif city_clipper['prepared'].intersects(geom):
+		return geom.intersection(city_clipper['geom'])
+
+	return None
+
 def getVehicleMilesTraveled():
 	"""Tally up the vehicle miles travel, sorting the totals by
 	revenue/deadhead routes as well as by mode"""
@@ -1,68 +1,88 @@
 import argparse
+import csv
+import os
 import sys
-from collections import OrderedDict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
-from os.path import join
+from itertools import groupby
+from multiprocessing import Pool
+from os.path import basename, dirname, exists, join, splitext
 
 import cx_Oracle
 import fiona
+import numpy
 from fiona import crs
+from rtree import index
 from shapely.geometry import mapping, shape, LineString
+from shapely.ops import linemerge
+from shapely.prepared import prep
 
 DBNAME = 'HAWAII'
 USER = 'tmpublic'
 DATE_FORMAT = '%m/%d/%y'
 
+# number of shape points fetched from oracle at a time and the number of
+# features handed to each writerecords call
+FETCH_SIZE = 50000
+WRITE_BATCH = 5000
+
 HOME = '//gisstore/gis/PUBLIC/GIS_Projects/Vehicle_Miles'
 RLIS_DIR = '//gisstore/gis/Rlis'
 CITIES_PATH = join(RLIS_DIR, 'BOUNDARY', 'cty_fill.shp')
 
+# the assembled patterns and their volumes are cached in a geopackage for
+# each summary date so that oracle is only queried the first time a date
+# is analyzed, bump the version when the cached layer's content changes
+# so that stale caches aren't read
+CACHE_VERSION = 1
+CACHE_TEMPLATE = 'oracle_patterns_{0}_v{1}.gpkg'
 
-def create_pattern_geom_from_oracle():
-    """"""
+
+def create_pattern_geom_from_oracle(summary_dates):
+    """Build the pattern caches for the summary dates from oracle.  The
+    shape points and volumes of every date are fetched with a single query
+    each and the patterns are partitioned by their route begin date into a
+    cache per date.  The dates that oracle had patterns for are returned"""
 
     o_conn = cx_Oracle.connect(USER, ops.password, DBNAME)
     o_cur = o_conn.cursor()
+    o_cur.arraysize = FETCH_SIZE
 
-    q = """SELECT x_coordinate as x, y_coordinate as y, 
+    # rows come back grouped by pattern and in shape order so that the
+    # lines can be assembled in a single pass, see iter_pattern_shapes
+    q = """SELECT x_coordinate as x, y_coordinate as y,
              route_begin_date as begin_date, route_number as route,
-             direction, pattern_id as pattern, 
-             shape_point_distance as seq
+             direction, pattern_id as pattern
            from shape_point_distance
-           where route_begin_date = :begin_date"""
+           where route_begin_date in ({0})
+           order by route_begin_date, route_number, direction,
+             pattern_id, shape_point_distance"""
 
-    o_cur.execute(q, begin_date=ops.summary_date)
-    field_names = [d[0].lower() for d in o_cur.description]
+    date_params, date_binds = get_date_binds(summary_dates)
+    o_cur.execute(q.format(date_binds), date_params)
+    pattern_props = get_volume_usage_mode_attributes(summary_dates)
 
-    pattern_pts = {}
-    for row in o_cur.fetchall():
-        pt = dict(zip(field_names, row))
-        
-        coords = (pt.pop('x'), pt.pop('y'))
-        pt['coords'] = coords
-
-        date = pt.pop('begin_date')
-        route = pt.pop('route')
-        direct = pt.pop('direction')
-        patt = pt.pop('pattern')
-        k = (date, route, direct, patt)
+    cached_dates = list()
+    pattern_shapes = iter_pattern_shapes(o_cur)
+    for begin_date, shapes in groupby(pattern_shapes, lambda ps: ps[0][0]):
+        write_pattern_cache(
+            get_patterns_path(begin_date), shapes, pattern_props)
+        cached_dates.append(begin_date.date())
 
-        pattern_pts[k] = pattern_pts.get(k,[]) + [pt]
     o_conn.close()
+    return cached_dates
 
-    pattern_lines = {}
-    pattern_props = get_volume_usage_mode_attributes()
-    for pk, pt_list in pattern_pts.iteritems():
-        pt_list.sort(key=lambda k: k['seq'])
-        geom = LineString([d['coords'] for d in pt_list])
 
-        props = pattern_props[pk]
-        props['geom'] = geom
-        pattern_lines[pk] = props
+def write_pattern_cache(patterns_path, shapes, pattern_props):
+    """Write the (key, LineString) pairs of a summary date's patterns to
+    its cache along with their volumes.  The layer is written to a partial
+    file that only replaces the cache once it is complete so that an
+    interrupted run can't leave a truncated cache"""
 
     metadata = {
         'crs': crs.from_epsg(2913),
-        'driver': 'ESRI Shapefile',
+        'driver': 'GPKG',
+        'layer': 'patterns',
         'schema': {
             'geometry': 'LineString',
             'properties': OrderedDict([
@@ -78,10 +98,20 @@ def create_pattern_geom_from_oracle():
         }
     }
 
-    with fiona.open(ops.patterns_path, 'w', **metadata) as oracle_patterns:
-        for pk, fields in pattern_lines.iteritems():
+    cache_dir = dirname(patterns_path)
+    if not exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    partial_path = join(cache_dir, 'partial_' + basename(patterns_path))
+    if exists(partial_path):
+        os.remove(partial_path)
+
+    with fiona.open(partial_path, 'w', **metadata) as oracle_patterns:
+        batch = list()
+        for pk, geom in shapes:
+            fields = pattern_props[pk]
             feat = {
-                'geometry': mapping(fields['geom']),
+                'geometry': mapping(geom),
                 'properties': {
                     'begin_date': pk[0].strftime('%m/%d/%Y'),
                     'route': pk[1],
@@ -90,14 +120,84 @@ def create_pattern_geom_from_oracle():
                     'trip_count': fields['trip_count'],
                     'trip_mode': fields['trip_mode'],
                     'usage': fields['usage'],
-                    'len_miles': fields['geom'].length / 5280
+                    'len_miles': geom.length / 5280
                 }
             }
 
-            oracle_patterns.write(feat)
+            batch.append(feat)
+            if len(batch) >= WRITE_BATCH:
+                oracle_patterns.writerecords(batch)
+                batch = list()
+
+        oracle_patterns.writerecords(batch)
+
+    if exists(patterns_path):
+        os.remove(patterns_path)
+    os.rename(partial_path, patterns_path)
+
+
+def get_patterns_path(summary_date):
+    """"""
+
+    path_date = summary_date.strftime('%Y-%m-%d')
+    patterns_name = CACHE_TEMPLATE.format(path_date, CACHE_VERSION)
+    return join(HOME, 'gpkg', patterns_name)
+
 
+def get_date_binds(dates):
+    """Return a dictionary of bind parameters for the dates and the
+    placeholders that reference them, for use in an 'in' clause"""
 
-def get_volume_usage_mode_attributes():
+    date_params = OrderedDict(
+        ('d{0}'.format(i), d) for i, d in enumerate(dates))
+    date_binds = ', '.join(':{0}'.format(k) for k in date_params)
+
+    return date_params, date_binds
+
+
+def iter_pattern_shapes(o_cur):
+    """Yield a ((begin date, route, direction, pattern), LineString) pair
+    for each pattern in the executed query, whose rows must be x, y, begin
+    date, route, direction, pattern and be ordered by the pattern key and
+    then shape point distance.  Rows are fetched in blocks that are loaded
+    into numpy arrays and split where the key changes, the points of the
+    last pattern in a block are carried over to the next as it may not be
+    complete, so the time and memory used are linear in the row count"""
+
+    tail_xy = numpy.empty((0, 2), dtype=float)
+    tail_dates = numpy.empty(0, dtype=object)
+    tail_ids = numpy.empty((0, 3), dtype=int)
+
+    while True:
+        rows = o_cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+
+        xy = numpy.concatenate(
+            (tail_xy, numpy.array([r[:2] for r in rows], dtype=float)))
+        dates = numpy.concatenate(
+            (tail_dates, numpy.array([r[2] for r in rows], dtype=object)))
+        ids = numpy.concatenate(
+            (tail_ids, numpy.array([r[3:6] for r in rows], dtype=int)))
+
+        new_key = numpy.any(ids[1:] != ids[:-1], axis=1) | \
+            (dates[1:] != dates[:-1])
+        starts = numpy.concatenate(([0], numpy.flatnonzero(new_key) + 1))
+
+        for start, end in zip(starts[:-1], starts[1:]):
+            pk = (dates[start],) + tuple(ids[start].tolist())
+            yield pk, LineString(xy[start:end])
+
+        tail_xy = xy[starts[-1]:]
+        tail_dates = dates[starts[-1]:]
+        tail_ids = ids[starts[-1]:]
+
+    if len(tail_xy):
+        pk = (tail_dates[0],) + tuple(tail_ids[0].tolist())
+        yield pk, LineString(tail_xy)
+
+
+def get_volume_usage_mode_attributes(summary_dates):
     """"""
 
     o_conn = cx_Oracle.connect(USER, ops.password, DBNAME)
@@ -119,7 +219,7 @@ def get_volume_usage_mode_attributes():
            FROM trip t, pct_operated op, route r
            LEFT JOIN route_sub_type st
              ON st.route_sub_type = r.route_sub_type
-           WHERE t.trip_begin_date = :begin_date
+           WHERE t.trip_begin_date in ({0})
              AND t.trip_begin_date = op.summary_begin_date
              AND t.service_key = op.service_key
              AND r.route_begin_date = t.trip_begin_date
@@ -128,7 +228,8 @@ def get_volume_usage_mode_attributes():
              t.trip_begin_date, st.route_sub_type_description,
              r.route_usage"""
 
-    o_cur.execute(q, begin_date=ops.summary_date)
+    date_params, date_binds = get_date_binds(summary_dates)
+    o_cur.execute(q.format(date_binds), date_params)
     field_names = [d[0].lower() for d in o_cur.description]
     
     pattern_props = {}
@@ -173,28 +274,100 @@ def clip_patterns_to_city_limits(city_name, buffer=False):
     
     with fiona.open(ops.patterns_path) as oracle_patterns:
         metadata = oracle_patterns.meta.copy()
-        
-        with fiona.open(clip_path, 'w', **metadata) as pattern_clip:
-            for p in oracle_patterns:
-                geom = shape(p['geometry'])
+        metadata['driver'] = 'ESRI Shapefile'
+        patterns = list(oracle_patterns)
 
-                add_flag = False
-                if geom.within(city_geom):
-                    add_flag = True
-                elif geom.intersects(city_geom):
-                    geom = geom.intersection(city_geom)
-                    p['geometry'] = mapping(geom)
-                    add_flag = True
+    # patterns share long stretches of line work so each unique segment
+    # is clipped once and the patterns are reassembled from the clips
+    segments, pattern_segs = get_unique_segments(
+        [p['geometry']['coordinates'] for p in patterns])
 
-                if add_flag:
-                    props = p['properties']
-                    props['len_miles'] = (geom.length / 5280)
+    prepared_city = prep(city_geom)
+    seg_clips = [clip_segment(seg, city_geom, prepared_city)
+                 for seg in segments]
 
-                    pattern_clip.write(p)
+    with fiona.open(clip_path, 'w', **metadata) as pattern_clip:
+        for p, seg_ids in zip(patterns, pattern_segs):
+            parts = [g for i in seg_ids for g in seg_clips[i]]
+            if not parts:
+                continue
+
+            geom = linemerge(parts)
+            p['geometry'] = mapping(geom)
+
+            props = p['properties']
+            props['len_miles'] = sum(g.length for g in parts) / 5280
+
+            pattern_clip.write(p)
 
     return clip_path
 
 
+def get_unique_segments(lines):
+    """Break lines, supplied as coordinate sequences, into the unique
+    segments that they're built from.  Lines are split at every vertex
+    that isn't joined to exactly two others across all of the lines, at
+    each line's ends and wherever a line doubles back, so the runs of
+    vertices between splits are identical wherever lines share geometry,
+    whichever direction they travel.  A list of the unique segments'
+    coordinates and, for each line, a list of the indices of the segments
+    it's made of are returned"""
+
+    lines = [[tuple(c) for c in coords] for coords in lines]
+
+    neighbors = defaultdict(set)
+    ends = set()
+    for coords in lines:
+        ends.update((coords[0], coords[-1]))
+        for a, b in zip(coords[:-1], coords[1:]):
+            if a != b:
+                neighbors[a].add(b)
+                neighbors[b].add(a)
+
+    segments = list()
+    segment_ids = dict()
+    line_segments = list()
+    for coords in lines:
+        coords = [pt for i, pt in enumerate(coords)
+                  if i == 0 or pt != coords[i - 1]]
+
+        seg_ids = list()
+        run = [coords[0]]
+        for i, pt in enumerate(coords[1:], 1):
+            run.append(pt)
+
+            # a line that doubles back on itself is split where it turns
+            u_turn = i + 1 < len(coords) and coords[i + 1] == coords[i - 1]
+            if pt in ends or len(neighbors[pt]) != 2 or u_turn:
+                key = min(tuple(run), tuple(reversed(run)))
+                if key not in segment_ids:
+                    segment_ids[key] = len(segments)
+                    segments.append(key)
+
+                seg_ids.append(segment_ids[key])
+                run = [pt]
+
+        line_segments.append(seg_ids)
+
+    return segments, line_segments
+
+
+def clip_segment(coords, geom, prepared_geom):
+    """Return a list of the lines making up the part of the segment within
+    the polygon, points where the segment only touches the polygon are
+    dropped"""
+
+    line = LineString(coords)
+    if prepared_geom.contains(line):
+        return [line]
+    elif not prepared_geom.intersects(line):
+        return list()
+
+    clip = line.intersection(geom)
+    parts = getattr(clip, 'geoms', [clip])
+    return [g for g in parts if g.geom_type == 'LineString' and g.length]
+
+
 def get_vehicle_miles_traveled(patterns):
     """Tally up the vehicle miles travel, sorting the totals by
     revenue/deadhead routes as well as by mode"""
@@ -218,6 +391,200 @@ def get_vehicle_miles_traveled(patterns):
             print '{0}: {1:,.2f}'.format(mode, miles)
 
 
+def get_vehicle_miles_matrix(zones_path=CITIES_PATH, name_field='CITYNAME',
+                             buffer=False):
+    """Tally the vehicle miles traveled within every zone of a polygon
+    layer (all cities by default) and write them to one csv with a row
+    per zone and a column per usage/mode pair.  The zone totals are also
+    returned"""
+
+    zones = load_zones(zones_path, name_field, buffer)
+    zone_miles = tally_zone_miles(ops.patterns_path, zones)
+
+    write_vehicle_miles_matrix(zone_miles, zones_path)
+    return zone_miles
+
+
+def load_zones(zones_path, name_field, buffer=False):
+    """Read the zones of a polygon layer, returning their names,
+    geometries, prepared versions of the geometries and an rtree index of
+    their bounds"""
+
+    zone_names = list()
+    zone_geoms = list()
+    zone_ix = index.Index()
+    with fiona.open(zones_path) as zones:
+        for z in zones:
+            geom = shape(z['geometry'])
+
+            # see clip_patterns_to_city_limits for why this exists, note
+            # that buffered zones overlap their neighbors by 100 feet
+            if buffer:
+                geom = geom.buffer(100)
+
+            zone_ix.insert(len(zone_geoms), geom.bounds)
+            zone_names.append(z['properties'][name_field])
+            zone_geoms.append(geom)
+
+    prepared = [prep(g) for g in zone_geoms]
+    return zone_names, zone_geoms, prepared, zone_ix
+
+
+def tally_zone_miles(patterns_path, zones):
+    """Sum the vehicle miles of the cached patterns within each of the
+    zones in a single pass.  Each unique pattern segment (see
+    get_unique_segments) is only intersected with the zones that its
+    bounds touch and the miles are accumulated in memory by zone, usage
+    and mode"""
+
+    zone_names, zone_geoms, prepared, zone_ix = zones
+    with fiona.open(patterns_path) as pats:
+        patterns = [(p['geometry']['coordinates'], p['properties'])
+                    for p in pats]
+
+    segments, pattern_segs = get_unique_segments([p[0] for p in patterns])
+
+    # the daily trips crossing each unique segment by usage and mode, a
+    # segment's clipped length only has to be multiplied by these
+    seg_trips = [defaultdict(float) for seg in segments]
+    for (coords, props), seg_ids in zip(patterns, pattern_segs):
+        k = (props['usage'], props['trip_mode'])
+        for i in seg_ids:
+            seg_trips[i][k] += props['trip_count']
+
+    zone_miles = defaultdict(float)
+    for seg, trips in zip(segments, seg_trips):
+        bounds = LineString(seg).bounds
+        for i in zone_ix.intersection(bounds):
+            clip = clip_segment(seg, zone_geoms[i], prepared[i])
+            if not clip:
+                continue
+
+            clip_miles = sum(g.length for g in clip) / 5280
+            for (usage, mode), trip_count in trips.items():
+                k = (zone_names[i], usage, mode)
+                zone_miles[k] += clip_miles * trip_count
+
+    return zone_miles
+
+
+def write_vehicle_miles_matrix(zone_miles, zones_path):
+    """"""
+
+    columns = sorted({k[1:] for k in zone_miles})
+    zones = sorted({k[0] for k in zone_miles})
+
+    zones_name = splitext(basename(zones_path))[0]
+    matrix_name = 'vehicle_miles_{0}_{1}.csv'.format(zones_name, ops.path_date)
+    matrix_dir = join(HOME, 'csv')
+    if not exists(matrix_dir):
+        os.makedirs(matrix_dir)
+
+    matrix_path = join(matrix_dir, matrix_name)
+
+    with open(matrix_path, 'wb') as matrix_csv:
+        writer = csv.writer(matrix_csv)
+        writer.writerow(
+            ['zone'] + ['{0} {1}'.format(*c) for c in columns] + ['total'])
+
+        for zone in zones:
+            miles = [zone_miles.get((zone,) + c, 0) for c in columns]
+            writer.writerow([zone] + miles + [sum(miles)])
+
+    return matrix_path
+
+
+def get_vehicle_miles_series(summary_dates, zones_path=CITIES_PATH,
+                             name_field='CITYNAME', buffer=False,
+                             processes=1):
+    """Tally the vehicle miles within every zone for each of the summary
+    dates and write them to a single csv with a row per date, zone, usage
+    and mode.  Dates that aren't cached yet (or all of them if a refresh
+    is requested) are fetched from oracle together, then the periods are
+    tallied in a process pool with each worker loading the zones once"""
+
+    if ops.refresh:
+        fetch_dates = summary_dates
+    else:
+        fetch_dates = [d for d in summary_dates
+                       if not exists(get_patterns_path(d))]
+
+    if fetch_dates:
+        cached_dates = create_pattern_geom_from_oracle(fetch_dates)
+        for d in sorted(set(fetch_dates) - set(cached_dates)):
+            print 'no patterns found for summary date: {0}'.format(d)
+
+    period_dates = [d for d in summary_dates
+                    if exists(get_patterns_path(d))]
+    if not period_dates:
+        return None
+
+    pool = Pool(processes, initializer=init_period_worker,
+                initargs=(zones_path, name_field, buffer))
+    results = pool.map(tally_period_miles, period_dates, chunksize=1)
+    pool.close()
+    pool.join()
+
+    zones_name = splitext(basename(zones_path))[0]
+    series_name = 'vehicle_miles_{0}_{1}_{2}.csv'.format(
+        zones_name, min(period_dates).strftime('%Y-%m-%d'),
+        max(period_dates).strftime('%Y-%m-%d'))
+    series_dir = join(HOME, 'csv')
+    if not exists(series_dir):
+        os.makedirs(series_dir)
+
+    series_path = join(series_dir, series_name)
+
+    with open(series_path, 'wb') as series_csv:
+        writer = csv.writer(series_csv)
+        writer.writerow(
+            ['summary_date', 'zone', 'usage', 'trip_mode', 'vehicle_miles'])
+
+        for summary_date, zone_miles in sorted(results):
+            for (zone, usage, mode), miles in sorted(zone_miles.items()):
+                writer.writerow(
+                    [summary_date.strftime('%Y-%m-%d'), zone, usage, mode,
+                     miles])
+
+    return series_path
+
+
+def init_period_worker(zones_path, name_field, buffer):
+    """Load and index the zones a single time in each worker process
+    rather than for every period"""
+
+    global period_zones
+    period_zones = load_zones(zones_path, name_field, buffer)
+
+
+def tally_period_miles(summary_date):
+    """"""
+
+    patterns_path = get_patterns_path(summary_date)
+    zone_miles = tally_zone_miles(patterns_path, period_zones)
+
+    return summary_date, dict(zone_miles)
+
+
+def get_summary_dates(start_date, end_date):
+    """Return the summary begin dates from the 'summary_period' table that
+    fall within the date range"""
+
+    o_conn = cx_Oracle.connect(USER, ops.password, DBNAME)
+    o_cur = o_conn.cursor()
+
+    q = """SELECT summary_begin_date
+           from summary_period
+           where summary_begin_date between :start_date and :end_date
+           order by summary_begin_date"""
+
+    o_cur.execute(q, start_date=start_date, end_date=end_date)
+    summary_dates = [row[0].date() for row in o_cur.fetchall()]
+
+    o_conn.close()
+    return summary_dates
+
+
 def valid_date(date_str):
     """"""
 
@@ -240,12 +607,56 @@ def process_options(args=None):
         help='password for database: {0}, user: {1}'.format(
             DBNAME, USER)
     )
-    parser.add_argument(
+    dates = parser.add_mutually_exclusive_group(required=True)
+    dates.add_argument(
         '-sd', '--summary_date',
-        required=True,
+        nargs='+',
         type=valid_date,
         help='summary begin date routes in the TRANS schema, must be in the'
-             'format m/d/yy and appear in the "summary_period" table'
+             'format m/d/yy and appear in the "summary_period" table, if '
+             'more than one is supplied a vehicle miles time series is '
+             'written for the zones'
+    )
+    dates.add_argument(
+        '-dr', '--date_range',
+        nargs=2,
+        type=valid_date,
+        metavar=('START_DATE', 'END_DATE'),
+        help='write a vehicle miles time series for the zones covering '
+             'every summary period that begins within this range, dates '
+             'must be in the format m/d/yy'
+    )
+    parser.add_argument(
+        '-r', '--refresh',
+        action='store_true',
+        help='rebuild the cached patterns for the summary date from oracle '
+             'even if they already exist'
+    )
+    parser.add_argument(
+        '-m', '--matrix',
+        action='store_true',
+        help='tally vehicle miles for every zone of the zone layer (cities '
+             'by default) in one pass and write them to a matrix csv, '
+             'rather than clipping to a single city'
+    )
+    parser.add_argument(
+        '-z', '--zones',
+        nargs=2,
+        default=(CITIES_PATH, 'CITYNAME'),
+        metavar=('PATH', 'NAME_FIELD'),
+        help='polygon layer and its name field used in matrix mode'
+    )
+    parser.add_argument(
+        '-b', '--buffer',
+        action='store_true',
+        help='buffer the zones by 100 feet in matrix mode'
+    )
+    parser.add_argument(
+        '-j', '--processes',
+        type=int,
+        default=1,
+        help='number of processes that summary periods are tallied with '
+             'when a time series is written'
     )
 
     options = parser.parse_args(args)
@@ -259,13 +670,32 @@ def main():
     args = sys.argv[1:]
     ops = process_options(args)
 
-    ops.path_date = ops.summary_date.strftime('%Y-%m-%d')
-    patterns_name = 'oracle_patterns_{0}.shp'.format(ops.path_date)
-    ops.patterns_path = join(HOME, 'shp', patterns_name)
+    if ops.date_range:
+        summary_dates = get_summary_dates(*ops.date_range)
+    else:
+        summary_dates = sorted(set(ops.summary_date))
+
+    if len(summary_dates) > 1 or ops.date_range:
+        get_vehicle_miles_series(summary_dates, ops.zones[0], ops.zones[1],
+                                 ops.buffer, ops.processes)
+        return
 
-    create_pattern_geom_from_oracle()
-    clip_path = clip_patterns_to_city_limits('Beaverton', True)
-    get_vehicle_miles_traveled(clip_path)
+    ops.summary_date = summary_dates[0]
+    ops.path_date = ops.summary_date.strftime('%Y-%m-%d')
+    ops.patterns_path = get_patterns_path(ops.summary_date)
+
+    if ops.refresh or not exists(ops.patterns_path):
+        cached_dates = create_pattern_geom_from_oracle([ops.summary_date])
+        if ops.summary_date not in cached_dates:
+            print 'no patterns found for summary date: {0}'.format(
+                ops.path_date)
+            return
+
+    if ops.matrix:
+        get_vehicle_miles_matrix(ops.zones[0], ops.zones[1], ops.buffer)
+    else:
+        clip_path = clip_patterns_to_city_limits('Beaverton', True)
+        get_vehicle_miles_traveled(clip_path)
 
 
 if __name__ == '__main__':